@@ -0,0 +1,10 @@
+"""
+    Benchmarks for warc-extractor.
+
+    generate builds deterministic synthetic warc files, run times the
+    extractor on them and saves the results as JSON, so that runs on
+    different commits can be compared. Run from the repository root:
+
+        python -m benchmarks.run -output results.json
+        python -m benchmarks.run -compare results.json
+"""
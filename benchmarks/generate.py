@@ -0,0 +1,239 @@
+"""
+    Deterministic synthetic warc files for benchmarks.
+
+    The same arguments always produce the same bytes. Records are built with
+    WARCRecord and written by WARCRecord.write_to, so the files look like
+    what the extractor itself writes.
+
+        python -m benchmarks.generate bench.warc.gz -records 2000 -seed 1
+"""
+
+from email.utils import formatdate
+import argparse
+import base64
+import datetime
+import gzip
+import hashlib
+import math
+import random
+import uuid
+
+from warc_extractor.warc_extractor import WARCRecord, WARCWriter
+
+# (content type, extension, is text, weight)
+MIME_TYPES = [
+    ("text/html", ".html", True, 50),
+    ("text/css", ".css", True, 8),
+    ("application/javascript", ".js", True, 10),
+    ("image/png", ".png", False, 15),
+    ("image/jpeg", ".jpg", False, 12),
+    ("application/pdf", ".pdf", False, 5),
+]
+STATUSES = [("200 OK", 85), ("301 Moved Permanently", 5), ("404 Not Found", 8), ("500 Internal Server Error", 2)]
+HOSTS = ["example.com", "www.example.org", "news.example.net", "static.example.com", "blog.example.io"]
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et "
+         "dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea "
+         "commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla").split()
+DEFAULT_MIX = {"response": 6, "request": 3, "metadata": 1}
+START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class Generator:
+    """Makes synthetic warc records from a seeded random number generator.
+
+    :params mix: relative weights of the response, request and metadata
+                 records.
+    :params mean_size: mean size of response bodies in bytes. Sizes follow a
+                       log-normal distribution, capped at max_size.
+    :params chunked: share of responses sent with chunked transfer encoding.
+    :params gzipped: share of text responses sent gzip content encoded.
+    :params duplicates: share of responses repeating an earlier url and body.
+                        Repeats are picked from a reservoir sample of at
+                        most pool_size earlier responses, so memory stays
+                        bounded however many records are made.
+    """
+
+    def __init__(self, seed=0, mix=None, mean_size=16384, max_size=1 << 20, chunked=0.1, gzipped=0.2,
+                 duplicates=0.05, pool_size=256):
+        self.random = random.Random(seed)
+        self.mix = mix or DEFAULT_MIX
+        self.sigma = 1.0
+        self.mu = math.log(mean_size) - self.sigma ** 2 / 2
+        self.max_size = max_size
+        self.chunked = chunked
+        self.gzipped = gzipped
+        self.duplicates = duplicates
+        self.number = 0
+        self.pool_size = pool_size
+        self.seen = []
+        self.originals = 0
+
+    def _choice(self, items):
+        """Picks one of items, tuples ending in their weight."""
+        return self.random.choices(items, [i[-1] for i in items])[0]
+
+    def _header(self, warc_type, url=None, content_type=None):
+        headers = {
+            "WARC-Type": warc_type,
+            "WARC-Record-ID": "<urn:uuid:{}>".format(uuid.UUID(int=self.random.getrandbits(128), version=4)),
+            "WARC-Date": (START + datetime.timedelta(seconds=self.number)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+        if url is not None:
+            headers["WARC-Target-URI"] = url
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        self.number += 1
+        return headers
+
+    def _size(self):
+        return max(1, min(int(self.random.lognormvariate(self.mu, self.sigma)), self.max_size))
+
+    def _text(self, size):
+        words = self.random.choices(WORDS, k=size // 6 + 1)
+        return " ".join(words).encode()[:size]
+
+    def _url(self, extension):
+        host = self.random.choice(HOSTS)
+        folders = self.random.choices(WORDS, k=self.random.randint(0, 3))
+        name = self.random.choice(WORDS) + str(self.random.randint(0, 999)) + extension
+        return "http://{}/{}".format(host, "/".join(folders + [name]))
+
+    def _body(self, content_type, is_text):
+        size = self._size()
+        if not is_text:
+            return self.random.getrandbits(8 * size).to_bytes(size, "little")
+        if content_type == "text/html":
+            return b"<html><body><p>" + self._text(size) + b"</p></body></html>"
+        return self._text(size)
+
+    def _chunk(self, body):
+        pieces = []
+        pos = 0
+        while pos < len(body):
+            size = self.random.randint(1024, 65536)
+            piece = body[pos:pos + size]
+            pieces.append(b"%x\r\n%s\r\n" % (len(piece), piece))
+            pos += size
+        pieces.append(b"0\r\n\r\n")
+        return b"".join(pieces)
+
+    def _remember(self, response):
+        """Adds response to the duplicate candidates, replacing a random one once the pool is full."""
+        self.originals += 1
+        if len(self.seen) < self.pool_size:
+            self.seen.append(response)
+            return
+        index = self.random.randrange(self.originals)
+        if index < self.pool_size:
+            self.seen[index] = response
+
+    def warcinfo(self):
+        payload = b"software: warc-extractor benchmarks\r\nformat: WARC File Format 1.0\r\n"
+        return WARCRecord(payload=payload, headers=self._header("warcinfo", content_type="application/warc-fields"))
+
+    def response(self):
+        if self.seen and self.random.random() < self.duplicates:
+            url, status, fields, body = self.random.choice(self.seen)
+        else:
+            content_type, extension, is_text, _ = self._choice(MIME_TYPES)
+            url = self._url(extension)
+            status = self._choice(STATUSES)[0]
+            fields = [("Content-Type", content_type)]
+            if status.startswith("200"):
+                body = self._body(content_type, is_text)
+                if is_text and self.random.random() < self.gzipped:
+                    body = gzip.compress(body, mtime=0)
+                    fields.append(("Content-Encoding", "gzip"))
+            elif status.startswith("301"):
+                fields = [("Location", self._url(extension))]
+                body = b""
+            else:
+                fields = [("Content-Type", "text/html")]
+                body = b"<html><body><h1>" + status.encode() + b"</h1></body></html>"
+            self._remember((url, status, fields, body))
+
+        fields = [("Date", formatdate(self.number + START.timestamp(), usegmt=True))] + fields
+        digest = "sha1:" + base64.b32encode(hashlib.sha1(body).digest()).decode()
+        if body and self.random.random() < self.chunked:
+            fields.append(("Transfer-Encoding", "chunked"))
+            body = self._chunk(body)
+        else:
+            fields.append(("Content-Length", str(len(body))))
+        head = "HTTP/1.1 {}\r\n{}\r\n".format(status, "".join("{}: {}\r\n".format(*i) for i in fields))
+        headers = self._header("response", url, "application/http; msgtype=response")
+        headers["WARC-Payload-Digest"] = digest
+        return WARCRecord(payload=head.encode() + body, headers=headers)
+
+    def request(self):
+        url = self._url(".html")
+        host, _, path = url[len("http://"):].partition("/")
+        payload = "GET /{} HTTP/1.1\r\nHost: {}\r\nUser-Agent: warc-extractor-benchmark\r\nAccept: */*\r\n\r\n"
+        return WARCRecord(payload=payload.format(path, host).encode(),
+                          headers=self._header("request", url, "application/http; msgtype=request"))
+
+    def metadata(self):
+        url = self._url(".html")
+        links = "".join("outlink: {}\r\n".format(self._url(".html")) for _ in range(self.random.randint(1, 20)))
+        return WARCRecord(payload=links.encode(), headers=self._header("metadata", url, "application/warc-fields"))
+
+    def records(self, count):
+        """Yields a warcinfo record followed by count - 1 records of the configured mix."""
+        yield self.warcinfo()
+        for _ in range(count - 1):
+            yield getattr(self, self._choice(list(self.mix.items()))[0])()
+
+
+def generate(filename, records=1000, seed=0, compress=None, **options):
+    """Writes records synthetic warc records to filename.
+
+    compress is 'record' to gzip every record on its own, like most
+    crawlers do, or 'file' to gzip the file as a whole. It defaults to
+    'record' for filenames ending in .gz. Other options go to Generator.
+    """
+    if compress is None and filename.endswith(".gz"):
+        compress = "record"
+    generator = Generator(seed, **options)
+    if compress == "file":
+        with open(filename, "wb") as raw, gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as fp:
+            for record in generator.records(records):
+                record.write_to(fp)
+    else:
+        with WARCWriter(filename, compress=compress == "record") as writer:
+            for record in generator.records(records):
+                writer.write_record(record)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes a deterministic synthetic warc file.")
+    parser.add_argument("filename", help="File to write, gzipped when it ends in .gz.")
+    parser.add_argument("-records", type=int, default=1000, help="Number of records. Defaults to 1000.")
+    parser.add_argument("-seed", type=int, default=0, help="Seed of the random records. Defaults to 0.")
+    parser.add_argument("-compress", choices=["record", "file"],
+                        help="'record' gzips every record on its own, 'file' the whole file. "
+                             "Defaults to 'record' for .gz files.")
+    parser.add_argument("-mix", default="response:6,request:3,metadata:1",
+                        help="Relative weights of the record types. Defaults to response:6,request:3,metadata:1.")
+    parser.add_argument("-mean_size", type=int, default=16384,
+                        help="Mean size of response bodies in bytes, sizes are log-normal. Defaults to 16384.")
+    parser.add_argument("-max_size", type=int, default=1 << 20, help="Largest response body. Defaults to 1MB.")
+    parser.add_argument("-chunked", type=float, default=0.1,
+                        help="Share of responses with chunked transfer encoding. Defaults to 0.1.")
+    parser.add_argument("-gzipped", type=float, default=0.2,
+                        help="Share of text responses with gzip content encoding. Defaults to 0.2.")
+    parser.add_argument("-duplicates", type=float, default=0.05,
+                        help="Share of responses repeating an earlier url and body. Defaults to 0.05.")
+    args = parser.parse_args()
+
+    mix = {}
+    for item in args.mix.split(","):
+        name, _, weight = item.partition(":")
+        if name not in DEFAULT_MIX:
+            parser.error("-mix types must be one of " + ", ".join(DEFAULT_MIX))
+        mix[name] = float(weight or 1)
+
+    generate(args.filename, args.records, args.seed, args.compress, mix=mix, mean_size=args.mean_size,
+             max_size=args.max_size, chunked=args.chunked, gzipped=args.gzipped, duplicates=args.duplicates)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+    Times warc-extractor on synthetic warc files.
+
+    Every scenario runs the command line tool in a fresh process on every
+    corpus, a few times over, and the fastest run counts. Corpora are
+    generated once per number of records and seed and reused afterwards.
+
+        python -m benchmarks.run -output before.json
+        python -m benchmarks.run -compare before.json -output after.json
+"""
+
+from statistics import median
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (file name, compress)
+CORPORA = {
+    "plain": ("bench.warc", None),
+    "record-gzip": ("bench.warc.gz", "record"),
+    "file-gzip": ("bench.warc.gz", "file"),
+}
+
+# name: extractor arguments
+SCENARIOS = {
+    "summary": [],
+    "filter": ["-silence", "warc-type:response", "http:content-type:html", "http:error:200..299"],
+    "dump-warc": ["-dump", "warc", "http:error:200"],
+    "dump-content": ["-dump", "content"],
+}
+
+
+def corpus(work, name, records, seed):
+    """Returns the folder holding corpus name, generating it first if needed."""
+    filename, compress = CORPORA[name]
+    folder = os.path.join(work, "{}-{}-{}".format(name, records, seed))
+    if not os.path.exists(os.path.join(folder, filename)):
+        print("generating", name, "corpus with", records, "records")
+        os.makedirs(folder, exist_ok=True)
+        generate(os.path.join(folder, filename + ".tmp"), records, seed, compress)
+        os.replace(os.path.join(folder, filename + ".tmp"), os.path.join(folder, filename))
+    return folder
+
+
+def time_run(arguments, output_path):
+    """Runs the extractor once with arguments and returns the seconds it took."""
+    shutil.rmtree(output_path, ignore_errors=True)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    command = [sys.executable, "-m", "warc_extractor.warc_extractor", "-output_path", output_path] + arguments
+    start = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, env=env, check=True)
+    return time.perf_counter() - start
+
+
+def commit():
+    """Returns the commit of the checked out code, if it is a git checkout."""
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def run(args):
+    results = {}
+    for name in args.corpora:
+        folder = corpus(args.work, name, args.records, args.seed)
+        size = os.path.getsize(os.path.join(folder, CORPORA[name][0]))
+        for scenario in args.scenarios:
+            arguments = ["-path", folder] + shlex.split(args.args) + SCENARIOS[scenario]
+            seconds = [time_run(arguments, os.path.join(args.work, "output")) for _ in range(args.repeat)]
+            key = "{}/{}".format(scenario, name)
+            results[key] = {
+                "seconds": seconds,
+                "best": min(seconds),
+                "median": median(seconds),
+                "bytes": size,
+                "mb_per_second": size / min(seconds) / 1e6,
+            }
+            print("{:<26}{:>9.3f}s{:>9.1f} MB/s".format(key, min(seconds), results[key]["mb_per_second"]))
+    shutil.rmtree(os.path.join(args.work, "output"), ignore_errors=True)
+    return {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "records": args.records,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "args": args.args,
+        "results": results,
+    }
+
+
+def compare(old, new):
+    """Prints the best times of two runs side by side."""
+    print("-----------------------------")
+    print("{:<26}{:>10}{:>10}{:>9}".format("scenario", "before", "after", "change"))
+    for key, result in new["results"].items():
+        before = old["results"].get(key)
+        if before is None:
+            print("{:<26}{:>10}{:>9.3f}s".format(key, "-", result["best"]))
+            continue
+        change = 100 * (result["best"] - before["best"]) / before["best"]
+        print("{:<26}{:>9.3f}s{:>9.3f}s{:>8.1f}%".format(key, before["best"], result["best"], change))
+    if old.get("records") != new.get("records") or old.get("seed") != new.get("seed"):
+        print("\nThe runs used different corpora, -records or -seed differ.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times warc-extractor on synthetic warc files.")
+    parser.add_argument("-records", type=int, default=2000, help="Records per corpus. Defaults to 2000.")
+    parser.add_argument("-seed", type=int, default=0, help="Seed of the generated corpora. Defaults to 0.")
+    parser.add_argument("-repeat", type=int, default=3,
+                        help="Runs per scenario, the fastest one counts. Defaults to 3.")
+    parser.add_argument("-corpora", nargs="+", choices=list(CORPORA), default=list(CORPORA),
+                        help="Corpora to run on. Defaults to all of them.")
+    parser.add_argument("-scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help="Scenarios to run. Defaults to all of them.")
+    parser.add_argument("-args", default="",
+                        help="Extra arguments for every run of the extractor, given with an equals sign as they "
+                             "start with a dash, e.g. -args=-mmap or -args='-workers 4'.")
+    parser.add_argument("-work", default=os.path.join(tempfile.gettempdir(), "warc-extractor-benchmarks"),
+                        help="Folder for the corpora and the output of runs. Defaults to a folder in the "
+                             "temporary directory.")
+    parser.add_argument("-output", help="File to save the results to as JSON.")
+    parser.add_argument("-compare", help="Results of an earlier run to compare with.")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=1)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fp:
+            compare(json.load(fp), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -36,25 +36,101 @@ Python library to work with WARC files.
 """
 
 from collections.abc import MutableMapping
-from http.client import HTTPMessage
 from urllib.parse import urlparse, unquote
 from pprint import pprint
 import os
 import argparse
 import mimetypes
-import email.parser
 import gzip
 import datetime
 import uuid
 import re
 import io
 import hashlib
+import collections
+import base64
+import tempfile
+import tarfile
+import zipfile
+import json
+import zlib
+import shutil
+import itertools
+import bisect
+import concurrent.futures
+import mmap
+import sys
+import operator
+import queue
+import threading
+import time
+import contextlib
+import cProfile
+import pstats
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, -stats goes without peak memory use there.
+    resource = None
+
+try:
+    # Faster drop in replacements for zlib, used to decompress warc files when installed.
+    from zlib_ng import zlib_ng as fast_zlib
+except ImportError:
+    try:
+        from isal import isal_zlib as fast_zlib
+    except ImportError:
+        fast_zlib = zlib
 
 # ---------------------------------------------------
 #                      warc.utils                  -
 # ---------------------------------------------------
 SEP = re.compile("[;:=]")
 
+# Largest single read or write used when streaming data.
+CHUNK_SIZE = 1 << 20
+
+
+def copy_range(src, dst, offset, count):
+    """Copies count bytes at offset of file descriptor src to file descriptor dst inside the kernel.
+
+    Uses copy_file_range, or sendfile where that isn't available. Returns the
+    number of bytes copied, which is short when the system can't copy
+    between these files, the caller copies the rest itself.
+    """
+    copied = 0
+    for name in ("copy_file_range", "sendfile"):
+        if not hasattr(os, name):
+            continue
+        try:
+            while copied < count:
+                if name == "copy_file_range":
+                    n = os.copy_file_range(src, dst, count - copied, offset + copied)
+                else:
+                    n = os.sendfile(dst, src, offset + copied, count - copied)
+                if not n:
+                    break
+                copied += n
+            return copied
+        except OSError:
+            # e.g. files on different file systems, or opened for appending.
+            pass
+    return copied
+
+
+def copy_payload(payload, fp):
+    """Writes the unread rest of a record payload to fp in bounded chunks."""
+    if isinstance(payload, FilePart):
+        payload.copy_to(fp)
+    else:
+        shutil.copyfileobj(payload, fp, CHUNK_SIZE)
+
 
 class CaseInsensitiveDict(MutableMapping):
     """Almost like a dictionary, but keys are case-insensitive.
@@ -70,6 +146,7 @@ class CaseInsensitiveDict(MutableMapping):
         >>> d.keys()
         ["foo", "bar"]
     """
+    __slots__ = ("_d",)
 
     def __init__(self, *args, **kwargs):
         self._d = {}
@@ -94,50 +171,274 @@ class CaseInsensitiveDict(MutableMapping):
         return len(self._d)
 
 
+class StreamBuffer:
+    """Buffered file interface with cheap unread and readline.
+
+    Data is read from the file in blocks into a single reusable bytearray.
+    read() copies straight out of that buffer, unread() of data that was just
+    read only moves the position back and readline() searches the buffer
+    instead of reading byte by byte.
+    """
+
+    def __init__(self, fileobj, buffer_size=1 << 16):
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        # GzipFile claims to be seekable but only emulates it by decompressing.
+        self.seekable = (not isinstance(fileobj, (gzip.GzipFile, GzipMemberFile))
+                         and getattr(fileobj, "seekable", bool)())
+        # read1 never reads past a gzip member, which keeps tell() usable at record boundaries.
+        self._read1 = getattr(fileobj, "read1", fileobj.read)
+        self._buf = bytearray()
+        self._pos = 0
+        # Whether the buffer holds exactly the bytes before the file position, see seek().
+        self._mirrors = True
+
+    def _fill(self, size):
+        """Buffers at least size bytes, unless the file ends first. Returns the number of bytes buffered."""
+        if len(self._buf) - self._pos >= size:
+            return len(self._buf) - self._pos
+        del self._buf[:self._pos]
+        self._pos = 0
+        if not self._buf:
+            self._mirrors = True
+        while len(self._buf) < size:
+            data = self._read1(max(self.buffer_size, size - len(self._buf)))
+            if not data:
+                break
+            self._buf += data
+        return len(self._buf)
+
+    def _take(self, size):
+        if size < 4096:
+            # Slicing twice beats setting up a memoryview for short lines.
+            content = bytes(self._buf[self._pos:self._pos + size])
+        else:
+            with memoryview(self._buf) as view:
+                content = bytes(view[self._pos:self._pos + size])
+        self._pos += len(content)
+        return content
+
+    def read(self, size=-1):
+        available = len(self._buf) - self._pos
+        if 0 <= size <= available:
+            return self._take(size)
+        if 0 <= size <= self.buffer_size:
+            self._fill(size)
+            return self._take(size)
+
+        # Large reads bypass the buffer.
+        content = self._take(available)
+        del self._buf[:]
+        self._pos = 0
+        self._mirrors = True
+        return content + self.fileobj.read(size if size < 0 else size - available)
+
+    def readuntil(self, separator, size=-1):
+        """Reads up to and including separator, or less at the end of the file or after size bytes."""
+        end = self._buf.find(separator, self._pos)
+        while end == -1:
+            searched = len(self._buf) - self._pos
+            if 0 <= size <= searched or self._fill(searched + 1) <= searched:
+                break
+            end = self._buf.find(separator, self._pos + max(searched - len(separator) + 1, 0))
+        length = len(self._buf) - self._pos if end == -1 else end + len(separator) - self._pos
+        return self._take(length if size < 0 else min(length, size))
+
+    def readline(self, size=-1):
+        return self.readuntil(b"\n", size)
+
+    def buffered(self):
+        """Returns how many bytes can be read without reading from the file."""
+        return len(self._buf) - self._pos
+
+    def unread(self, content):
+        size = len(content)
+        with memoryview(self._buf) as view:
+            rewind = size <= self._pos and view[self._pos - size:self._pos] == content
+        if rewind:
+            self._pos -= size
+        else:
+            self._buf[self._pos:self._pos] = content
+            self._mirrors = False
+
+    def skip(self, size):
+        """Discards the next size bytes.
+
+        Seekable files are skipped with a single seek, anything else (e.g. a
+        gzip stream) is drained in bounded chunks so the data is never held in
+        memory as a whole.
+        """
+        skipped = min(size, len(self._buf) - self._pos)
+        self._pos += skipped
+        remaining = size - skipped
+        if not remaining:
+            return
+        del self._buf[:]
+        self._pos = 0
+        self._mirrors = True
+        if self.seekable:
+            self.fileobj.seek(remaining, os.SEEK_CUR)
+            return
+
+        while remaining > 0:
+            chunk = self.fileobj.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+    def tell(self):
+        ahead = len(self._buf) - self._pos
+        if ahead and isinstance(self.fileobj, GzipMemberFile) and not self.fileobj.inflated:
+            raise io.UnsupportedOperation("Position is not at a gzip member boundary.")
+        return self.fileobj.tell() - ahead
+
+    def seek(self, offset):
+        """Moves to offset, within the buffer when it is still there.
+
+        Seeking backwards in a gzip stream starts decompressing over from the
+        beginning, which must not happen for every record that lies in data
+        already buffered.
+        """
+        # Offsets within a gzip member don't map to positions in the file.
+        if self._mirrors and not (isinstance(self.fileobj, GzipMemberFile) and not self.fileobj.inflated):
+            try:
+                end = self.fileobj.tell()
+            except io.UnsupportedOperation:
+                end = None
+            if end is not None and end - len(self._buf) <= offset <= end:
+                self._pos = offset - (end - len(self._buf))
+                return
+        del self._buf[:]
+        self._pos = 0
+        self._mirrors = True
+        self.fileobj.seek(offset)
+
+
+class MmapBuffer(StreamBuffer):
+    """StreamBuffer over a memory mapped file.
+
+    read() hands out memoryview slices of the mapping instead of copies, so
+    payloads can be written straight from the page cache. readline() still
+    returns bytes since lines are parsed.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.seekable = True
+        self._map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self._pos = fileobj.tell()
+
+    def read(self, size=-1):
+        end = len(self._map) if size < 0 else min(self._pos + size, len(self._map))
+        content = self._view[self._pos:end]
+        self._pos = end
+        return content
+
+    def readuntil(self, separator, size=-1):
+        end = self._map.find(separator, self._pos)
+        end = len(self._map) if end == -1 else end + len(separator)
+        if size >= 0:
+            end = min(end, self._pos + size)
+        line = self._map[self._pos:end]
+        self._pos = end
+        return line
+
+    def unread(self, content):
+        size = len(content)
+        if size > self._pos or self._view[self._pos - size:self._pos] != content:
+            raise ValueError("Only data that was just read can be unread from a memory mapped file.")
+        self._pos -= size
+
+    def buffered(self):
+        # Nothing is copied into memory, reads go to the mapping.
+        return 0
+
+    def skip(self, size):
+        self._pos = min(self._pos + size, len(self._map))
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset):
+        self._pos = offset
+
+    def close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # Payload views are still in use, the mapping goes away with them.
+            pass
+
+
 class FilePart:
     """File interface over a part of file.
 
     Takes a file and length to read from the file and returns a file-object
-    over that part of the file.
+    over that part of the file. Buffering is left to a shared StreamBuffer.
     """
+    __slots__ = ("fileobj", "length", "offset")
 
     def __init__(self, fileobj, length):
+        if not isinstance(fileobj, StreamBuffer):
+            fileobj = StreamBuffer(fileobj)
         self.fileobj = fileobj
         self.length = length
         self.offset = 0
-        self.buf = b''
 
     def read(self, size=-1):
-        if size == -1:
-            size = self.length
-
-        if len(self.buf) >= size:
-            content = self.buf[:size]
-            self.buf = self.buf[size:]
-        else:
-            size = min(size, self.length - self.offset)
-            content = self.buf + self.fileobj.read(size - len(self.buf))
-            self.buf = b''
+        remaining = self.length - self.offset
+        content = self.fileobj.read(remaining if size < 0 else min(size, remaining))
         self.offset += len(content)
         return content
 
     def unread(self, content):
-        self.buf = content + self.buf
+        self.fileobj.unread(content)
         self.offset -= len(content)
 
-    def readline(self, size=1024):
-        chunks = []
-        chunk = self.read(size)
-        while chunk and b"\n" not in chunk:
-            chunks.append(chunk)
-            chunk = self.read(size)
+    def rewind(self):
+        """Goes back to the start of the part, only memory mapped files can do so after any read."""
+        self.fileobj.seek(self.fileobj.tell() - self.offset)
+        self.offset = 0
 
-        if b"\n" in chunk:
-            index = chunk.index(b"\n")
-            self.unread(chunk[index + 1:])
-            chunk = chunk[:index + 1]
-        chunks.append(chunk)
-        return b"".join(chunks)
+    def readuntil(self, separator, size=-1):
+        remaining = self.length - self.offset
+        content = self.fileobj.readuntil(separator, remaining if size < 0 else min(size, remaining))
+        self.offset += len(content)
+        return content
+
+    def readline(self, size=-1):
+        return self.readuntil(b"\n", size)
+
+    def copy_to(self, fp):
+        """Writes the unread remainder of this part to fp without holding it in memory.
+
+        Large parts of plain files written to plain files are copied by the
+        kernel, see copy_range.
+        """
+        fp.write(self.read(min(self.fileobj.buffered(), self.length - self.offset)))
+
+        remaining = self.length - self.offset
+        source = self.fileobj.fileobj
+        if (remaining >= CHUNK_SIZE and self.fileobj.seekable and isinstance(source, (io.BufferedReader, io.FileIO))
+                and isinstance(fp, (io.BufferedWriter, io.FileIO))):
+            position = self.fileobj.tell()
+            fp.flush()
+            copied = copy_range(source.fileno(), fp.fileno(), position, remaining)
+            self.fileobj.seek(position + copied)
+            self.offset += copied
+
+        while self.offset < self.length:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            fp.write(chunk)
+
+    def skip(self):
+        """Discards the unread remainder of this part."""
+        self.fileobj.skip(self.length - self.offset)
+        self.offset = self.length
 
     def __iter__(self):
         line = self.readline()
@@ -147,7 +448,12 @@ class FilePart:
 
 
 class HTTPObject(CaseInsensitiveDict):
-    """Small object to help with parsing HTTP warc entries"""
+    """Small object to help with parsing HTTP warc entries
+
+    The header block is read up front but only split into fields when they
+    are first used.
+    """
+    __slots__ = ("_id", "fields", "hstring", "payload", "_content", "_body")
 
     def __init__(self, request_file):
         # Parse version line
@@ -178,25 +484,73 @@ class HTTPObject(CaseInsensitiveDict):
             "version": version,
         }
 
-        self._header, self.hstring = self._parse_headers(request_file)
-        super().__init__(self._header)
+        self.hstring = self._read_headers(request_file)
         self.payload = request_file
         self._content = None
+        self._body = None
+
+    def __getattr__(self, name):
+        # Only called while the header fields have not been split yet.
+        if name not in ("_d", "fields"):
+            raise AttributeError(name)
+        with stage("http"):
+            self.fields = self._split_headers(self.hstring)
+        self._d = {}
+        for key, value in self.fields:
+            # Like email.message.Message the first of duplicate headers wins, see get_all.
+            self._d.setdefault(key.lower(), value)
+        return getattr(self, name)
 
     @staticmethod
-    def _parse_headers(fp):
-        """This is a modification of the python3 http.clint.parse_headers function."""
-        headers = []
-        while True:
-            line = fp.readline(65536)
-            headers.append(line)
-            if line in (b'\r\n', b'\n', b''):
-                break
-        hstring = b''.join(headers)
-        return email.parser.Parser(_class=HTTPMessage).parsestr(hstring.decode('iso-8859-1')), hstring
+    def _read_headers(fp, size=1 << 20):
+        """Reads the header lines up to and including the first empty line."""
+        # Read the usual CRLF terminated block at once, then look for an earlier bare LF empty line.
+        hstring = fp.readuntil(b"\r\n\r\n", size)
+        if hstring[:1] == b"\n" or hstring[:2] == b"\r\n":
+            end = hstring.index(b"\n") + 1
+        else:
+            ends = [i + n for i, n in ((hstring.find(b"\n\n"), 2), (hstring.find(b"\n\r\n"), 3)) if i != -1]
+            end = min(ends) if ends else len(hstring)
+        fp.unread(hstring[end:])
+        hstring = hstring[:end]
+        if len(hstring) == size:
+            # Unusually long header, finish it line by line.
+            lines = [hstring]
+            while lines[-1] not in (b'\r\n', b'\n', b''):
+                lines.append(fp.readline(65536))
+            hstring = b''.join(lines)
+        return hstring
+
+    @staticmethod
+    def _split_headers(hstring):
+        """Splits a header block into (name, value) pairs.
+
+        Headers are decoded as iso-8859-1, which accepts any byte. Folded lines
+        are joined to the header before them with a single space and lines
+        that are not headers are skipped. Duplicate headers are all kept in
+        order.
+        """
+        fields = []
+        for text in hstring.decode('iso-8859-1').split('\n'):
+            text = text.rstrip('\r')
+            if not text:
+                continue
+            if text[0] in ' \t':
+                if fields:
+                    fields[-1] = (fields[-1][0], (fields[-1][1] + ' ' + text.strip()).strip())
+                continue
+            name, colon, value = text.partition(':')
+            if colon and name and ' ' not in name and '\t' not in name:
+                fields.append((name, value.strip()))
+        return fields
 
     def __repr__(self):
-        return self.vline + str(self._header)
+        return self.vline + "".join("{}: {}\n".format(name, value) for name, value in self.fields)
+
+    def get_all(self, name, failobj=None):
+        """Returns the values of every header called name, in order."""
+        name = name.lower()
+        return [value for key, value in self.fields if key.lower() == name] or failobj
 
     def __getitem__(self, name):
         try:
@@ -213,15 +567,18 @@ class HTTPObject(CaseInsensitiveDict):
                 raise
 
     def reset(self):
+        if isinstance(self.payload, FilePart) and isinstance(self.payload.fileobj, MmapBuffer):
+            # Positions in the mapping are absolute, so the start is known even when part of the body was read.
+            self.payload.rewind()
+            return
         self.payload.unread(self.hstring)
         self.payload.unread(self._id['vline'])
 
     def write_to(self, f):
         f.write(self._id['vline'])
         f.write(self.hstring)
-        f.write(self.payload.read())
+        copy_payload(self.payload, f)
         f.write(b"\r\n\r\n")
-        f.flush()
 
     @property
     def content(self):
@@ -241,29 +598,197 @@ class HTTPObject(CaseInsensitiveDict):
     def version(self):
         return self._id["version"]
 
-    def write_payload_to(self, fp):
-        encoding = self._header.get("Transfer-Encoding", "None")
-        if encoding == "chunked":
-            found = b''
-            length = int(str(self.payload.readline(), "iso-8859-1").rstrip(), 16)
-            while length > 0:
-                found += self.payload.read(length)
+    def iter_body(self):
+        """Iterates over the message body in pieces of at most CHUNK_SIZE bytes, undoing chunked transfer encoding."""
+        encoding = self._d.get("transfer-encoding", "None")
+        if encoding.lower().endswith("chunked"):
+            line = self.payload.readline()
+            while line:
+                length = int(str(line, "iso-8859-1").split(";")[0].strip(), 16)
+                if length == 0:
+                    break
+                yield from self._iter_payload(length)
                 self.payload.readline()
-                length = int(str(self.payload.readline(), "iso-8859-1").rstrip(), 16)
+                line = self.payload.readline()
         else:
-            length = int(self._header.get("Content-Length", -1))
-            found = self.payload.read(length)
+            yield from self._iter_payload(int(self._d.get("content-length", -1)))
+
+    def _iter_payload(self, length):
+        while length != 0:
+            chunk = self.payload.read(CHUNK_SIZE if length < 0 else min(length, CHUNK_SIZE))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+    def body_suffix(self):
+        """File suffix for the body as write_payload_to writes it, e.g. '.gz' for gzip it can't decode.
+
+        The first decoded piece is taken to find out, write_payload_to carries
+        on from there.
+        """
+        if self._body is None:
+            decoder = ContentDecoder(self.get("content-encoding"))
+            chunks = self.iter_body()
+            pieces = decoder.decode(next(chunks, b""))
+            first = next(pieces, None)
+            self._body = (decoder, pieces if first is None else itertools.chain([first], pieces), chunks)
+        decoder = self._body[0]
+        return ContentDecoder.suffix(decoder.encoding, decoder.failed)
+
+    def write_payload_to(self, fp, decode=True):
+        """Writes the message body to fp with bounded memory.
+
+        Content encodings are decoded when decode is set and ContentDecoder
+        supports them, otherwise the body is written as it was sent.
+        """
+        if decode:
+            self.body_suffix()
+            decoder, pieces, chunks = self._body
+        else:
+            decoder, pieces, chunks = ContentDecoder(None), [], self.iter_body()
+        for piece in pieces:
+            fp.write(piece)
+        for chunk in chunks:
+            for piece in decoder.decode(chunk):
+                fp.write(piece)
+        for piece in decoder.flush():
+            fp.write(piece)
+        if decoder.error is not None:
+            print("unable to decode content, keeping the part decoded so far:", decoder.error)
+
+
+class ContentDecoder:
+    """Streaming decoder for HTTP content encodings.
+
+    Handles gzip, deflate and, when the brotli package is installed, br.
+    decode() and flush() are generators that only decompress the next piece,
+    of at most CHUNK_SIZE bytes for zlib, once the last one was used, so
+    small compressed bodies can't blow up in memory. Bodies with an unsupported
+    encoding, or whose start doesn't decode, are passed through untouched.
+    Later errors stop the output and are kept in error.
+    """
+    SUFFIXES = {"gzip": ".gz", "x-gzip": ".gz", "deflate": ".zz", "br": ".br"}
+    ERRORS = (zlib.error, brotli.error) if brotli else (zlib.error,)
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.failed = False
+        self.error = None
+        self._started = False
+        encodings = self.parse(encoding) if self.can_decode(encoding) else []
+        # Encodings are listed in the order they were applied.
+        self._stages = [_BrotliStage() if i == "br" else _ZlibStage(i) for i in reversed(encodings)]
+
+    @staticmethod
+    def parse(encoding):
+        return [i.strip().lower() for i in (encoding or "").split(",") if i.strip().lower() not in ("", "identity")]
+
+    @classmethod
+    def can_decode(cls, encoding):
+        supported = {"gzip", "x-gzip", "deflate"} | ({"br"} if brotli else set())
+        return all(i in supported for i in cls.parse(encoding))
 
-        fp.write(found)
+    @classmethod
+    def suffix(cls, encoding, failed=False):
+        """File suffix for a body that is left encoded, e.g. '.br' when brotli is missing."""
+        if cls.can_decode(encoding) and not failed:
+            return ""
+        return "".join(cls.SUFFIXES.get(i, "") for i in cls.parse(encoding))
+
+    @staticmethod
+    def _through(stage, pieces, flush=False):
+        for piece in pieces:
+            yield from stage.decode(piece)
+        if flush:
+            yield from stage.flush()
+
+    def decode(self, data):
+        if self.error is not None:
+            return
+        pieces = [data]
+        for stage in self._stages:
+            pieces = self._through(stage, pieces)
+        try:
+            for piece in pieces:
+                self._started = True
+                yield piece
+        except self.ERRORS as e:
+            if self._started:
+                self.error = e
+                return
+            # Not in the encoding it is labelled with, keep the body as it was sent.
+            self._stages = []
+            self.failed = True
+            yield data
+        self._started = self._started or bool(data)
+
+    def flush(self):
+        if self.error is not None:
+            return
+        pieces = []
+        for stage in self._stages:
+            pieces = self._through(stage, pieces, flush=True)
+        try:
+            yield from pieces
+        except self.ERRORS as e:
+            self.error = e
+
+
+class _ZlibStage:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._d = None
+
+    def decode(self, data):
+        if self._d is None:
+            if not data:
+                return
+            wbits = zlib.MAX_WBITS | 16
+            if self.encoding == "deflate":
+                # Servers send deflate both with and without the zlib wrapper.
+                wrapped = len(data) > 1 and data[0] & 0x0f == 8 and (data[0] << 8 | data[1]) % 31 == 0
+                wbits = zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS
+            self._d = zlib.decompressobj(wbits)
+
+        while not self._d.eof:
+            piece = self._d.decompress(data, CHUNK_SIZE)
+            data = self._d.unconsumed_tail
+            if piece:
+                yield piece
+            elif not data:
+                break
+
+    def flush(self):
+        return [self._d.flush()] if self._d is not None else []
+
+
+class _BrotliStage:
+    def __init__(self):
+        self._d = brotli.Decompressor()
+
+    def decode(self, data):
+        if data:
+            yield self._d.process(bytes(data))
+
+    def flush(self):
+        return []
 
 
 class ContentType(CaseInsensitiveDict):
+    __slots__ = ("type", "_string")
+
     def __init__(self, string):
+        # Parameters are only parsed when first used.
+        self._string = string
+        self.type = string.split(";", 1)[0].strip().lower() if string else ''
+
+    def __getattr__(self, name):
+        if name != "_d":
+            raise AttributeError(name)
         data = {}
-        self.type = ''
-        if string:
-            _list = [i.strip() for i in string.lower().split(";")]
-            self.type = _list[0]
+        if self._string:
+            _list = [i.strip() for i in self._string.lower().split(";")]
             data["type"] = _list[0]
             for i in _list[1:]:
                 test = [n.strip() for n in re.split(SEP, i)]
@@ -271,7 +796,8 @@ class ContentType(CaseInsensitiveDict):
                 if len(test) > 1:
                     data[test[0]] = test[1]
 
-        super().__init__(data)
+        self._d = data
+        return data
 
     def __repr__(self):
         return self.type
@@ -315,13 +841,68 @@ class WARCHeader(CaseInsensitiveDict):
         "content_type": "Content-Type",
         "content_length": "Content-Length"
     }
+    __slots__ = ("version", "_raw", "_start")
+    # Raw header names mapped to their interned lowercase form.
+    NAMES = {}
 
     def __init__(self, headers, defaults=False):
         self.version = "WARC/1.0"
+        self._raw = None
         super().__init__(headers)
         if defaults:
             self.init_defaults()
 
+    @classmethod
+    def from_raw(cls, block, start):
+        """Wraps a header block checked by WARCReader without splitting it.
+
+        start is the offset of the first header line in block. The block is
+        split into fields when they are first used and values are decoded when
+        they are first accessed.
+        """
+        header = cls.__new__(cls)
+        header.version = "WARC/1.0"
+        header._raw = block
+        header._start = start
+        return header
+
+    def __getattr__(self, name):
+        # Only called while the raw block has not been split yet.
+        if name != "_d" or self._raw is None:
+            raise AttributeError(name)
+        self._d = self._split(self._raw, self._start)
+        self._raw = None
+        return self._d
+
+    @classmethod
+    def _split(cls, block, start):
+        headers = {}
+        if start == len(block) - 2:
+            return headers
+        names = cls.NAMES
+        for line in block[start:-4].split(b"\r\n"):
+            name, _, value = line.partition(b":")
+            key = names.get(name)
+            if key is None:
+                key = sys.intern(name.decode().lower())
+                if len(names) < 4096:
+                    names[name] = key
+            headers[key] = value.lstrip(b" ")
+        return headers
+
+    def __getitem__(self, name):
+        key = name.lower()
+        value = self._d[key]
+        if type(value) is bytes:
+            value = self._d[key] = value.decode("utf-8")
+        return value
+
+    def __contains__(self, name):
+        return name.lower() in self._d
+
+    def __eq__(self, other):
+        return isinstance(other, CaseInsensitiveDict) and dict(self.items()) == dict(other.items())
+
     def __repr__(self):
         return "<WARCHeader: type={}, record_id={}>".format(self.type, self.record_id)
 
@@ -357,6 +938,12 @@ class WARCHeader(CaseInsensitiveDict):
     @property
     def content_length(self):
         """The Content-Length header as int."""
+        raw = self._raw
+        if raw is not None:
+            # Usually the only field needed before the record is filtered, so look it up without splitting.
+            pos = raw.find(b"\r\nContent-Length:", self._start - 2)
+            if pos != -1 and raw.find(b"\r\nContent-Length:", pos + 17) == -1:
+                return int(raw[pos + 17:raw.index(b"\r\n", pos + 2)])
         return int(self['Content-Length'])
 
     @property
@@ -378,6 +965,7 @@ class WARCHeader(CaseInsensitiveDict):
 class WARCRecord(object):
     """The WARCRecord object represents a WARC Record.
     """
+    __slots__ = ("header", "payload", "_http", "_content")
 
     def __init__(self, header=None, payload=None, headers=None, defaults=True):
         """Creates a new WARC record.
@@ -388,7 +976,7 @@ class WARCRecord(object):
         if header is None and defaults is True:
             headers.setdefault("WARC-Type", "response")
 
-        self.header = header or WARCHeader(headers, defaults=True)
+        self.header = header if header is not None else WARCHeader(headers, defaults=True)
 
         if defaults is True and 'Content-Length' not in self.header:
             if payload:
@@ -402,7 +990,8 @@ class WARCRecord(object):
         if isinstance(payload, str):
             payload = payload.encode()
         if isinstance(payload, bytes):
-            payload = io.BytesIO(payload)
+            # HTTP payloads are parsed from it and put back with unread() before writing.
+            payload = StreamBuffer(io.BytesIO(payload))
 
         self.payload = payload
         self._http = None
@@ -416,10 +1005,9 @@ class WARCRecord(object):
         self.header.write_to(f)
         if self.http:
             self.http.reset()
-        f.write(self.payload.read())
+        copy_payload(self.payload, f)
         f.write(b"\r\n")
         f.write(b"\r\n")
-        f.flush()
 
     @property
     def content(self):
@@ -435,7 +1023,8 @@ class WARCRecord(object):
     def http(self):
         if self._http is None:
             if 'application/http' in self.header['content-type']:
-                self._http = HTTPObject(self.payload)
+                with stage("http"):
+                    self._http = HTTPObject(self.payload)
             else:
                 self._http = False
         return self._http
@@ -514,8 +1103,267 @@ class WARCRecord(object):
         return WARCRecord(payload=payload, headers=headers)
 
 
+class GzipMemberFile:
+    """Read only file interface over a gzip file that keeps track of gzip members.
+
+    Unlike gzip.GzipFile every member is decompressed on its own, so reading
+    can start at the offset of any member. When a file holds one member per
+    record, tell() and seek() give random access to records in compressed
+    offsets.
+
+    Decompression uses zlib_ng or isal when one of them is installed.
+    """
+    # Offsets are positions in the compressed file.
+    inflated = False
+
+    def __init__(self, fileobj, chunk_size=io.DEFAULT_BUFFER_SIZE * 8):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._reset(fileobj.tell())
+
+    def _reset(self, offset):
+        self._offset = offset  # compressed offset of self._input[0]
+        self._input = b''
+        self._member = None
+        self._buf = b''
+        self._pos = 0
+
+    def _feed(self):
+        """Decompresses the next block of the current member.
+
+        Returns False once the member is finished without producing data.
+        """
+        while not self._member.eof:
+            if not self._input:
+                self._input = self.fileobj.read(self.chunk_size)
+                if not self._input:
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                if stats is not None:
+                    stats.compressed += len(self._input)
+            with stage("decompress"):
+                data = self._member.decompress(self._input, self.chunk_size)
+            if stats is not None:
+                stats.decompressed += len(data)
+            rest = self._member.unused_data if self._member.eof else self._member.unconsumed_tail
+            self._offset += len(self._input) - len(rest)
+            self._input = rest
+            if data:
+                self._buf = data
+                self._pos = 0
+                return True
+        return False
+
+    def _fill(self):
+        """Refills the output buffer, moving on to the next member when needed.
+
+        Returns False at the end of the file.
+        """
+        while self._member is None or not self._feed():
+            # gzip allows zero padding between and after members.
+            while True:
+                stripped = self._input.lstrip(b"\0")
+                self._offset += len(self._input) - len(stripped)
+                self._input = stripped
+                if self._input:
+                    break
+                self._input = self.fileobj.read(self.chunk_size)
+                if not self._input:
+                    return False
+                if stats is not None:
+                    stats.compressed += len(self._input)
+            self._member = fast_zlib.decompressobj(zlib.MAX_WBITS | 16)
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._pos >= len(self._buf) and not self._fill():
+                break
+            end = len(self._buf) if size < 0 else self._pos + size
+            chunk = self._buf[self._pos:end]
+            self._pos += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def read1(self, size=-1):
+        """Reads up to size bytes with at most one decompression step, never crossing a member."""
+        if self._pos >= len(self._buf) and not self._fill():
+            return b''
+        end = len(self._buf) if size < 0 else self._pos + size
+        chunk = self._buf[self._pos:end]
+        self._pos += len(chunk)
+        return chunk
+
+    def readline(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._pos >= len(self._buf) and not self._fill():
+                break
+            end = self._buf.find(b"\n", self._pos) + 1 or len(self._buf)
+            if size > 0:
+                end = min(end, self._pos + size)
+                size -= end - self._pos
+            chunks.append(self._buf[self._pos:end])
+            self._pos = end
+            if chunks[-1].endswith(b"\n"):
+                break
+        return b"".join(chunks)
+
+    def tell(self):
+        """Returns the compressed offset of the gzip member starting at the current position.
+
+        Raises io.UnsupportedOperation when the position is inside a member.
+        """
+        if self._pos < len(self._buf) or (self._member is not None and self._feed()):
+            raise io.UnsupportedOperation("Position is not at a gzip member boundary.")
+        return self._offset
+
+    def seek(self, offset):
+        """Moves to the gzip member starting at the compressed offset."""
+        self.fileobj.seek(offset)
+        self._reset(offset)
+
+    def close(self):
+        self.fileobj.close()
+
+
+class GzipStreamFile(GzipMemberFile):
+    """Faster replacement for reading a gzip.GzipFile.
+
+    Large blocks are decompressed at a time and handed out without further
+    copying. Like gzip.GzipFile, tell() and seek() work in offsets into the
+    decompressed data, so seeking backwards starts over from the beginning of
+    the file.
+    """
+    inflated = True
+
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        super().__init__(fileobj, chunk_size)
+
+    def _reset(self, offset):
+        super()._reset(offset)
+        self._start = 0  # decompressed offset of self._buf[0]
+
+    def _feed(self):
+        consumed = len(self._buf)
+        if not super()._feed():
+            return False
+        self._start += consumed
+        return True
+
+    def tell(self):
+        return self._start + self._pos
+
+    def seek(self, offset):
+        if offset < self.tell():
+            self.fileobj.seek(0)
+            self._reset(0)
+        remaining = offset - self.tell()
+        while remaining > 0:
+            data = self.read1(min(remaining, CHUNK_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+        return self.tell()
+
+
+class ReadAheadFile:
+    """Read only file interface that reads the file ahead on a background thread.
+
+    Blocks of block_size bytes are read, and for compressed files
+    decompressed, into a queue of at most depth blocks while the caller
+    parses the blocks before them. zlib and file reads release the GIL, so
+    both run at the same time. Only sequential reading is supported.
+    """
+
+    def __init__(self, fileobj, block_size=CHUNK_SIZE, depth=4):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self._queue = queue.Queue(depth)
+        self._closed = threading.Event()
+        self._buf = b''
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            data = True
+            while data and not self._closed.is_set():
+                data = self.fileobj.read(self.block_size)
+                self._put(data)
+        except Exception as e:
+            # Raised in the reading thread once it gets this far.
+            self._put(e)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def seekable(self):
+        return False
+
+    def read1(self, size=-1):
+        """Reads up to size bytes from the current block."""
+        if self._pos >= len(self._buf):
+            if self._eof:
+                return b''
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+                return b''
+            self._buf = item
+            self._pos = 0
+        end = len(self._buf) if size < 0 else self._pos + size
+        chunk = self._buf[self._pos:end]
+        self._pos += len(chunk)
+        return chunk
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            chunk = self.read1(size)
+            if not chunk:
+                break
+            if size > 0:
+                size -= len(chunk)
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def tell(self):
+        raise io.UnsupportedOperation("Files read ahead can't tell their position.")
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.fileobj.close()
+
+
 class WARCFile:
-    def __init__(self, filename=None, mode=None, fileobj=None, compress=None):
+    def __init__(self, filename=None, mode=None, fileobj=None, compress=None, members=False, use_mmap=False,
+                 read_ahead=False):
+        """Opens a WARC file.
+
+        :params members: read gzip compressed files one gzip member at a time
+                         so that tell() and seek() work in compressed offsets,
+                         see GzipMemberFile.
+        :params use_mmap: memory map uncompressed files for reading, record
+                          payloads are then read as memoryview objects, see
+                          MmapBuffer.
+        :params read_ahead: read and decompress the file on a background
+                            thread, see ReadAheadFile. tell() and seek() are
+                            not available then.
+        """
         if fileobj is None:
             fileobj = open(filename, mode or "rb")
             mode = fileobj.mode
@@ -523,11 +1371,24 @@ class WARCFile:
         if compress is None and filename and filename.endswith(".gz"):
             compress = True
 
-        if compress:
+        if compress and members:
+            fileobj = GzipMemberFile(fileobj)
+        elif compress and "r" in (mode or "rb"):
+            fileobj = GzipStreamFile(fileobj)
+        elif compress:
             fileobj = gzip.open(fileobj, mode)
 
         self.fileobj = fileobj
         self._reader = None
+        self._mmap = None
+        if use_mmap and not compress:
+            try:
+                self._mmap = MmapBuffer(fileobj)
+            except (ValueError, OSError):
+                # Empty files and files without a descriptor can't be mapped.
+                pass
+        if read_ahead and self._mmap is None and "r" in (mode or "rb"):
+            self.fileobj = ReadAheadFile(self.fileobj)
 
     def __enter__(self):
         return self
@@ -541,7 +1402,7 @@ class WARCFile:
     @property
     def reader(self):
         if self._reader is None:
-            self._reader = WARCReader(self.fileobj)
+            self._reader = WARCReader(self._mmap or self.fileobj)
         return self._reader
 
     def write_record(self, warc_record):
@@ -554,46 +1415,265 @@ class WARCFile:
         return self.reader.read_record()
 
     def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
         self.fileobj.close()
 
     def tell(self):
         """Returns the file offset.
         """
-        return self.fileobj.tell()
+        if self._reader is None:
+            return self.fileobj.tell()
+        return self._reader.fileobj.tell()
+
+    def seek(self, offset):
+        """Moves to the record starting at offset, as previously returned by tell().
+        """
+        self.reader.fileobj.seek(offset)
+        self.reader.current_payload = None
+
+
+class WARCWriter:
+    """Long lived writer for warc output.
+
+    The output file is opened once with a large buffer instead of once per
+    record. Compressed output (a filename ending in .gz unless compress says
+    otherwise) stores every record as a gzip member of its own. With max_size
+    set, writing moves on to a new numbered file, e.g. output-00001.warc.gz,
+    once the current file has reached max_size bytes.
+
+    :params sizes: keep the size of every written record in self.sizes, so
+                   the output can later be copied record by record with
+                   append().
+    :params threaded: compress and write records on a background thread.
+                      Records are still read by the caller, only the writes
+                      are handed over. Errors show up on a later call.
+    :params resume: the file number and size returned by position(), to
+                    carry on writing where an interrupted run checkpointed.
+                    Anything written after that point is dropped.
+    """
+    # Tells the writing thread to finish.
+    STOP = object()
+
+    def __init__(self, filename, compress=None, max_size=None, buffer_size=1 << 20, sizes=False, threaded=False,
+                 resume=None):
+        self.filename = filename
+        self.compress = filename.endswith(".gz") if compress is None else compress
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+        self.sizes = [] if sizes else None
+        self.number = 0
+        if resume is None:
+            self.fileobj = open(filename, "wb", buffering=buffer_size)
+        else:
+            self.number, size = resume
+            self.fileobj = open(self._name(self.number), "r+b", buffering=buffer_size)
+            self.fileobj.truncate(size)
+            self.fileobj.seek(size)
+        self._start = 0
+        self._queue = None
+        self._error = None
+        if threaded:
+            self._queue = queue.Queue(16)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _name(self, number):
+        if number == 0:
+            return self.filename
+        head, tail = os.path.split(self.filename)
+        index = tail.find(".warc")
+        if index == -1:
+            index = len(tail)
+        return os.path.join(head, "{}-{:05d}{}".format(tail[:index], number, tail[index:]))
+
+    def _roll(self):
+        """Moves on to the next output file if the current one is full."""
+        if self.max_size and self.fileobj.tell() >= self.max_size:
+            self.fileobj.close()
+            self.number += 1
+            self.fileobj = open(self._name(self.number), "wb", buffering=self.buffer_size)
+
+    def _begin(self):
+        """Starts a record, returning the file object it is written to."""
+        self._roll()
+        self._start = self.fileobj.tell()
+        if self.compress:
+            return gzip.GzipFile(filename="", mode="wb", fileobj=self.fileobj, mtime=0)
+        return self.fileobj
+
+    def _end(self, target):
+        if target is not self.fileobj:
+            target.close()
+        if self.sizes is not None:
+            self.sizes.append(self.fileobj.tell() - self._start)
+
+    def write_record(self, record):
+        if self._queue is not None:
+            pipe = _RecordPipe(self._put)
+            try:
+                record.write_to(pipe)
+            finally:
+                pipe.flush()
+                self._put(None)
+            return
+
+        target = self._begin()
+        try:
+            record.write_to(target)
+        finally:
+            self._end(target)
+
+    def _put(self, item):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(item)
+
+    def _run(self):
+        """Writes the queued blocks, a None ends the current record."""
+        target = None
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self.STOP:
+                    break
+                if self._error is not None:
+                    # Keep taking blocks so the caller never blocks, it raises the error instead.
+                    continue
+                if target is None:
+                    target = self._begin()
+                if item is None:
+                    self._end(target)
+                    target = None
+                else:
+                    target.writelines(item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def position(self):
+        """Returns the number and size of the current output file once everything written so far is in it."""
+        if self._queue is not None:
+            self._queue.join()
+            if self._error is not None:
+                raise self._error
+        self.fileobj.flush()
+        return [self.number, self.fileobj.tell()]
+
+    def append(self, filename, sizes):
+        """Copies records written by another writer with sizes=True, e.g. in a worker process."""
+        if self._queue is not None:
+            self._queue.join()
+        with open(filename, "rb") as fp:
+            for size in sizes:
+                self._roll()
+                if size >= CHUNK_SIZE:
+                    self.fileobj.flush()
+                    copied = copy_range(fp.fileno(), self.fileobj.fileno(), fp.tell(), size)
+                    fp.seek(copied, os.SEEK_CUR)
+                    size -= copied
+                while size > 0:
+                    chunk = fp.read(min(size, CHUNK_SIZE))
+                    if not chunk:
+                        raise IOError("Unexpected end of file in %r" % filename)
+                    self.fileobj.write(chunk)
+                    size -= len(chunk)
+
+    def close(self):
+        if self._queue is not None:
+            self._queue.put(self.STOP)
+            self._thread.join()
+            self._queue = None
+        self.fileobj.close()
+        if self._error is not None:
+            raise self._error
+
+
+class _RecordPipe:
+    """Collects the writes of a record into blocks for WARCWriter's writing thread."""
+
+    def __init__(self, put, block_size=1 << 16):
+        self.put = put
+        self.block_size = block_size
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.put(self.chunks)
+            self.chunks = []
+            self.size = 0
 
 
 class WARCReader:
-    RE_VERSION = re.compile(r"WARC/(\d+.\d+)\r\n")
-    RE_HEADER = re.compile(r"([a-zA-Z_\-]+): *(.*)\r\n")
+    RE_VERSION = re.compile(rb"WARC/(\d+.\d+)\r\n")
+    RE_HEADER = re.compile(rb"([a-zA-Z_\-]+): *(.*)\r\n")
+    RE_FIELDS = re.compile(rb"(?:[a-zA-Z_\-]+:[^\n]*\r\n)*")
     SUPPORTED_VERSIONS = ["1.0"]
+    # Anything longer is not a header, this keeps junk from being buffered whole.
+    MAX_HEADER_SIZE = 1 << 24
 
     def __init__(self, fileobj):
+        if not isinstance(fileobj, StreamBuffer):
+            fileobj = StreamBuffer(fileobj)
         self.fileobj = fileobj
         self.current_payload = None
 
     def read_header(self, fileobj):
-        version_line = fileobj.readline().decode("utf-8")
-        if not version_line:
+        """Reads the whole header block at once and checks it with a single regular expression.
+
+        The block is kept as it is and only split into fields when they are
+        used, see WARCHeader.from_raw.
+        """
+        block = fileobj.readuntil(b"\r\n\r\n", self.MAX_HEADER_SIZE)
+        if not block:
             return None
 
-        m = self.RE_VERSION.match(version_line)
+        m = self.RE_VERSION.match(block)
         if not m:
-            raise IOError("Bad version line: %r" % version_line)
-        version = m.group(1)
+            raise IOError("Bad version line: %r" % self._line(block, 0))
+        version = m.group(1).decode()
         if version not in self.SUPPORTED_VERSIONS:
             raise IOError("Unsupported WARC version: %s" % version)
+        if not block.isascii():
+            # Reject invalid text now rather than whenever the value is used.
+            block.decode("utf-8")
+
+        pos = m.end()
+        end = len(block) - 2
+        if not block.endswith(b"\r\n\r\n"):
+            # The file or the size limit ended before the header did.
+            raise IOError("Bad header line: %r" % self._bad_line(block, pos, len(block)))
+        if not self.RE_FIELDS.fullmatch(block, pos, end):
+            raise IOError("Bad header line: %r" % self._bad_line(block, pos, end))
+        return WARCHeader.from_raw(block, pos)
 
-        headers = {}
-        while True:
-            line = fileobj.readline().decode("utf-8")
-            if line == "\r\n":  # end of headers
-                break
-            m = self.RE_HEADER.match(line)
+    @staticmethod
+    def _line(block, pos):
+        end = block.find(b"\n", pos) + 1 or len(block)
+        return block[pos:end].decode("utf-8", "replace")
+
+    def _bad_line(self, block, pos, end):
+        """Finds the first line that is not a header, or the empty string when the header was cut short."""
+        while pos < end:
+            m = self.RE_HEADER.match(block, pos, end)
             if not m:
-                raise IOError("Bad header line: %r" % line)
-            name, value = m.groups()
-            headers[name] = value
-        return WARCHeader(headers)
+                return self._line(block, pos)
+            pos = m.end()
+        return self._line(block, len(block))
 
     @staticmethod
     def expect(fileobj, expected_line, message=None):
@@ -605,8 +1685,8 @@ class WARCReader:
     def finish_reading_current_record(self):
         # consume the footer from the previous record
         if self.current_payload:
-            # consume all data from the current_payload before moving to next record
-            self.current_payload.read()
+            # skip whatever the caller left unread before moving to next record
+            self.current_payload.skip()
             self.expect(self.current_payload.fileobj, "\r\n")
             self.expect(self.current_payload.fileobj, "\r\n")
             self.current_payload = None
@@ -644,25 +1724,147 @@ class WARCReader:
 # ---------------------------------------------------
 
 counts = {}
+# Stats of the running -stats or -progress, None when they are off.
+stats = None
 
 
 class FilterObject:
-    """Basic object for storing filters."""
+    """Basic object for storing filters.
+
+    Values are matched as case insensitive substrings, except for values
+    starting with ~ which are regular expressions, and comparisons like >=400
+    or ranges like 400..499 which compare numbers. The host and path keys
+    match the domain and the start of the path of WARC-Target-URI.
+    """
+    NUMBER = r"-?\d+(?:\.\d+)?"
+    RE_COMPARE = re.compile(r"(>=|<=|>|<)({})$".format(NUMBER))
+    RE_RANGE = re.compile(r"({0})\.\.({0})$".format(NUMBER))
+    URL_PARTS = ("host", "path")
+    OPERATORS = {">=": operator.ge, "<=": operator.le, ">": operator.gt, "<": operator.lt}
 
     def __init__(self, string):
+        self.string = string
         self.result = True
         if string[0] == "!":
             self.result = False
             string = string[1:]
 
-        _list = string.lower().split(":")
-
-        self.http = (_list[0] == 'http')
+        _list = string.split(":", 1)
+        self.http = (_list[0].lower() == 'http')
         if self.http:
-            del _list[0]
+            _list = _list[1:] and _list[1].split(":", 1)
+        if len(_list) != 2:
+            raise ValueError("Filter {} is not of the form key:value.".format(string))
+
+        self.k = _list[0].lower()
+        self.v = _list[1].lower()
+        self.field = "warc-target-uri" if self.url_part else self.k
+
+        # Cost is used to order filters, cheapest first.
+        compare = self.RE_COMPARE.match(self.v)
+        bounds = self.RE_RANGE.match(self.v)
+        self.pattern = self.compare = None
+        if self.v.startswith("~"):
+            self.pattern = re.compile(_list[1][1:], re.IGNORECASE)
+            cost = 3
+        elif compare:
+            self.compare = [(self.OPERATORS[compare.group(1)], float(compare.group(2)))]
+            cost = 1
+        elif bounds:
+            self.compare = [(operator.ge, float(bounds.group(1))), (operator.le, float(bounds.group(2)))]
+            cost = 1
+        else:
+            cost = 0
+        self.cost = cost + (2 if self.url_part else 0) + (10 if self.http else 0)
+
+    @property
+    def url_part(self):
+        return not self.http and self.k in self.URL_PARTS
+
+    def match(self, value):
+        """Check a header value against the filter. Missing values never match."""
+        if not value:
+            return False
+        if self.url_part:
+            url = urlparse(value)
+            value = url.hostname if self.k == "host" else url.path
+            if not value:
+                return False
+
+        if self.pattern is not None:
+            found = self.pattern.search(value) is not None
+        elif self.compare is not None:
+            try:
+                number = float(value)
+            except ValueError:
+                return False
+            found = all(compare(number, limit) for compare, limit in self.compare)
+        elif self.k == "host" and self.url_part:
+            found = value == self.v or value.endswith("." + self.v)
+        elif self.k == "path" and self.url_part:
+            found = value.lower().startswith(self.v)
+        else:
+            found = self.v in value.lower()
+        return found == self.result
+
+
+class FilterSet:
+    """Filters compiled into a single predicate.
+
+    Filters on the warc header are checked before the ones that need the HTTP
+    block parsed, so records rejected by the warc header never have their
+    payload read.
+    """
+
+    def __init__(self, filters=()):
+        self.filters = sorted(filters, key=lambda i: i.cost)
+
+    def __iter__(self):
+        return iter(self.filters)
+
+    def __len__(self):
+        return len(self.filters)
+
+    @property
+    def fingerprint(self):
+        """Identifies the filters regardless of their order, see SummaryCache."""
+        return hashlib.sha1("\n".join(sorted(i.string for i in self.filters)).encode("utf-8")).hexdigest()
+
+    def __call__(self, record):
+        for i in self.filters:
+            if i.http:
+                if not record.http:
+                    return False
+                value = record.http.get(i.field)
+            else:
+                value = record.header.get(i.field)
+
+            if not i.match(value):
+                return False
+        return True
+
+
+def merge_counts(part, into=None):
+    """Adds counts collected elsewhere, e.g. in a worker process, to counts or into."""
+    if into is None:
+        into = counts
+    for key, value in part.items():
+        if isinstance(value, dict):
+            holder = into.setdefault(key, {})
+            for obj, n in value.items():
+                holder[obj] = holder.get(obj, 0) + n
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+def dump_counts(part):
+    """Converts counts to JSON. JSON has no None keys, so nested counts become lists of pairs."""
+    return {key: value if isinstance(value, int) else list(value.items()) for key, value in part.items()}
+
 
-        self.k = _list[0]
-        self.v = _list[1]
+def load_counts(part):
+    """Reverses dump_counts."""
+    return {key: value if isinstance(value, int) else dict(value) for key, value in part.items()}
 
 
 def inc(obj, header=None, dic=None):
@@ -685,132 +1887,1271 @@ def inc(obj, header=None, dic=None):
         holder[obj] = 1
 
 
-def warc_records(string, path):
+def stage(name):
+    """Times the enclosed code as stage name of stats, does nothing when stats are off."""
+    return stats.stage(name) if stats is not None else NO_STAGE
+
+
+NO_STAGE = contextlib.nullcontext()
+
+
+class Stats:
+    """Throughput and timing of a run, for -stats and -progress.
+
+    Time is charged to one stage at a time. switch() starts a stage and
+    returns the one it interrupted, so the time spent decompressing while
+    reading a header only counts as decompressing. Only the thread that
+    made the Stats is timed, reading ahead happens in the background.
+    """
+
+    def __init__(self, progress=None, total=0):
+        self.thread = threading.get_ident()
+        self.started = time.time()
+        self.clock = self.last = time.perf_counter()
+        self.current = "other"
+        self.times = {}
+        self.files = {}
+        # Bytes read from and inflated by gzip files, see GzipMemberFile.
+        self.compressed = 0
+        self.decompressed = 0
+        self.records = 0
+        self.progress = progress
+        self.total = total
+        self.done = 0
+        self.next = time.monotonic() + (progress or 0)
+        self.file = None
+
+    def switch(self, name):
+        if threading.get_ident() != self.thread:
+            return None
+        now = time.perf_counter()
+        self.times[self.current] = self.times.get(self.current, 0.0) + now - self.last
+        previous, self.current, self.last = self.current, name, now
+        return previous
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        previous = self.switch(name)
+        try:
+            yield
+        finally:
+            if previous is not None:
+                self.switch(previous)
+
+    def begin(self, filename, size):
+        """Starts timing filename, of which size bytes are going to be parsed."""
+        self.file = {"name": filename, "size": size, "gzip": filename.endswith(".gz"), "records": self.records,
+                     "compressed": self.compressed, "decompressed": self.decompressed,
+                     "clock": time.perf_counter(), "offset": 0}
+
+    def iterate(self, records):
+        """Passes on the (offset, record) pairs of the current file, timing reading them as the header stage."""
+        self.switch("header")
+        for offset, record in records:
+            self.records += 1
+            if offset is not None:
+                self.file["offset"] = offset
+            if self.progress and time.monotonic() >= self.next:
+                self.print_progress()
+            yield offset, record
+            self.switch("header")
+
+    def end(self):
+        self.switch("other")
+        file = self.file
+        entry = self.files.setdefault(file["name"], {"records": 0, "bytes": 0, "decompressed": 0, "seconds": 0.0})
+        entry["records"] += self.records - file["records"]
+        entry["bytes"] += file["size"]
+        entry["decompressed"] += self.decompressed - file["decompressed"] if file["gzip"] else file["size"]
+        entry["seconds"] += time.perf_counter() - file["clock"]
+        self.done += file["size"]
+        self.file = None
+
+    def merge(self, report):
+        """Adds the report() of a worker process."""
+        for name, value in report["files"].items():
+            entry = self.files.setdefault(name, {"records": 0, "bytes": 0, "decompressed": 0, "seconds": 0.0})
+            for key in entry:
+                entry[key] += value[key]
+            self.done += value["bytes"]
+        for name, value in report["stages"].items():
+            self.times[name] = self.times.get(name, 0.0) + value
+        self.records += report["records"]
+        if self.progress and time.monotonic() >= self.next:
+            self.print_progress()
+
+    def print_progress(self):
+        done = self.done
+        if self.file is not None:
+            position = self.compressed - self.file["compressed"] if self.file["gzip"] else self.file["offset"]
+            done += min(position, self.file["size"])
+        elapsed = time.perf_counter() - self.clock
+        rate = done / elapsed if elapsed else 0
+        eta = datetime.timedelta(seconds=round((self.total - done) / rate)) if rate else "unknown"
+        print("progress: {:.1f}% of {:.1f} MB, {:.0f} records/s, {:.1f} MB/s, eta {}".format(
+            100 * done / max(self.total, 1), self.total / 1e6, self.records / max(elapsed, 1e-9), rate / 1e6, eta))
+        self.next = time.monotonic() + self.progress
+
+    @staticmethod
+    def _rates(entry, seconds):
+        for key in ("records", "bytes", "decompressed"):
+            entry[key + "_per_second"] = entry[key] / seconds if seconds else None
+        return entry
+
+    def report(self):
+        """Returns the stats as a JSON friendly dictionary."""
+        self.switch(self.current)
+        elapsed = time.perf_counter() - self.clock
+        files = {name: self._rates(dict(entry), entry["seconds"]) for name, entry in self.files.items()}
+        total = {key: sum(i[key] for i in self.files.values()) for key in ("bytes", "decompressed")}
+        total["records"] = self.records
+        report = {
+            "started": datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(),
+            "seconds": elapsed,
+            "stages": dict(self.times),
+            "files": files,
+        }
+        report.update(self._rates(total, elapsed))
+        if resource is not None:
+            # Linux counts kilobytes, macOS bytes.
+            unit = 1 if sys.platform == "darwin" else 1024
+            report["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+            report["peak_rss_workers"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+        return report
+
+
+class PathAllocator:
+    """Hands out unused file names for -dump content without probing the file system for each file.
+
+    The names in a folder are listed once, when the folder is first used, and
+    then kept up to date in memory along with a counter per file name, so
+    finding the next free name(n) costs no stat calls. Output folders from
+    earlier runs are picked up by that first listing. Callers still create
+    files exclusively, as other processes may take names meanwhile.
+    """
+
+    def __init__(self, on_disk=True):
+        self.on_disk = on_disk
+        self.folders = {}
+        self.counters = {}
+        # ContentWriter threads allocate again when a name turns out to be taken.
+        self.lock = threading.RLock()
+        # Every name handed out is written here, see Checkpoint.
+        self.log = None
+
+    def folder(self, path, create=True):
+        """Returns the set of names in folder path, creating it unless create is False.
+
+        Allocators that are not on_disk, e.g. for names inside an archive,
+        never touch the file system.
+        """
+        with self.lock:
+            names = self.folders.get(path)
+            if names is None:
+                if self.on_disk and create:
+                    os.makedirs(path, exist_ok=True)
+                names = self.folders[path] = set()
+                if self.on_disk and os.path.isdir(path):
+                    names.update(os.listdir(path))
+            return names
+
+    def allocate(self, path, file, create=True):
+        """Reserves a name for file in folder path, inserting a number before the extension when it is taken."""
+        with self.lock:
+            names = self.folder(path, create)
+            key = (path, file)
+            n = self.counters.get(key, 0)
+            index = file.rfind(".")
+            name = file
+            while True:
+                if n:
+                    name = file[:index] + "(" + str(n) + ")" + file[index:]
+                n += 1
+                if name not in names:
+                    break
+            self.counters[key] = n
+            names.add(name)
+            self.note(path + name)
+            return path + name
+
+    def note(self, filename):
+        """Logs a file about to be created, for files named elsewhere too."""
+        if self.log is not None:
+            with self.lock:
+                self.log.write(filename + "\n")
+                self.log.flush()
+
+    def state(self):
+        """Returns the numbering of names as a JSON friendly list, see restore()."""
+        with self.lock:
+            return [[path, file, n] for (path, file), n in self.counters.items()]
+
+    def restore(self, state):
+        """Continues numbering names where state, as returned by state(), left off.
+
+        Folders are listed again on first use.
+        """
+        with self.lock:
+            self.folders.clear()
+            self.counters = {(path, file): n for path, file, n in state}
+
+
+paths = PathAllocator()
+
+
+class StagingAllocator(PathAllocator):
+    """Hands out temporary names in folder staging to the content files of a -workers job.
+
+    How a duplicate name is numbered depends on every name handed out before
+    it, so jobs only record the names they asked for and place_staged() picks
+    the final ones in job order, as a sequential run would. Folders are still
+    created where the files end up.
+    """
+
+    def __init__(self, staging):
+        super().__init__()
+        self.staging = staging
+        self.names = []
+
+    def allocate(self, path, file, create=True):
+        with self.lock:
+            name = self.staging + str(len(self.names))
+            self.names.append((path, file, create, name))
+            return name
+
+
+def public_mode(fp):
+    """Gives a temporary file the permissions of any other new file, instead of its private 0600."""
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(fp.fileno(), 0o666 & ~umask)
+
+
+class SummaryCache:
+    """Remembers the counts of warc files between runs, so unchanged files are not parsed again.
+
+    Entries are keyed by the absolute path of a file and hold its identity,
+    the size, modification time and a hash of the first block, plus the
+    counts of each set of filters it was summarized with. A file whose
+    identity changed loses all its counts. The cache is a JSON file which is
+    replaced as a whole on save.
+    """
+    VERSION = 1
+    HEAD_SIZE = 1 << 16
+    # Filter sets remembered per file, the least recently used are dropped first.
+    MAX_SUMMARIES = 16
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = {}
+        try:
+            with open(filename, encoding="utf-8") as fp:
+                data = json.load(fp)
+            if data.get("version") == self.VERSION:
+                self.files = data["files"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            # Missing or unreadable caches simply start out empty.
+            pass
+
+    @classmethod
+    def identity(cls, filename):
+        stat = os.stat(filename)
+        with open(filename, "rb") as fp:
+            head = hashlib.sha1(fp.read(cls.HEAD_SIZE)).hexdigest()
+        return [stat.st_size, stat.st_mtime_ns, head]
+
+    def _entry(self, filename):
+        """Returns the entry of filename if the file has not changed since it was stored."""
+        entry = self.files.get(os.path.abspath(filename))
+        try:
+            if entry is not None and entry["identity"] == self.identity(filename):
+                return entry
+        except OSError:
+            pass
+        return None
+
+    def get(self, filename, fingerprint):
+        """Returns the counts of filename for the filters with fingerprint, or None if they are not cached."""
+        entry = self._entry(filename)
+        summary = entry and entry["summaries"].pop(fingerprint, None)
+        if summary is None:
+            return None
+        entry["summaries"][fingerprint] = summary
+        return load_counts(summary)
+
+    def put(self, filename, fingerprint, summary):
+        entry = self._entry(filename)
+        if entry is None:
+            entry = self.files[os.path.abspath(filename)] = {"identity": self.identity(filename), "summaries": {}}
+        summaries = entry["summaries"]
+        summaries.pop(fingerprint, None)
+        summaries[fingerprint] = dump_counts(summary)
+        while len(summaries) > self.MAX_SUMMARIES:
+            del summaries[next(iter(summaries))]
+
+    def clear(self):
+        self.files = {}
+
+    def prune(self):
+        """Drops the entries of files that were deleted or changed, returns how many."""
+        stale = [i for i in self.files if self._entry(i) is None]
+        for i in stale:
+            del self.files[i]
+        return len(stale)
+
+    def save(self):
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=folder, delete=False) as fp:
+            json.dump({"version": self.VERSION, "files": self.files}, fp)
+            public_mode(fp)
+        os.replace(fp.name, self.filename)
+
+
+class Checkpoint:
+    """Journal that lets -resume carry on with an interrupted run as if it had never stopped.
+
+    Every interval seconds save() records the files finished so far, the
+    offset of the next record in the current file, the counts, the numbering
+    of content files and the sizes of the output files. The names of content
+    files created after a checkpoint go to a log, as they are handed out.
+    Resuming deletes those files, cuts the outputs back to their checkpointed
+    sizes and parses again from the checkpointed record, which recreates the
+    same files under the same names.
+    """
+    VERSION = 1
+    NAME = "checkpoint.json"
+    # Files that are only ever appended to, along with the warc output.
+    OUTPUTS = ("error.warc", "manifest.jsonl")
+
+    def __init__(self, args):
+        self.args = args
+        self.filename = args.output_path + self.NAME
+        self.done = []
+        self.file = None
+        self.offset = None
+        self.generation = 0
+        self.log = None
+        self.writer = None
+        self.next = 0
+
+    @staticmethod
+    def fingerprint(args):
+        """Identifies the arguments that change the output, a run can only be resumed with the same ones."""
+        options = [args.filter.fingerprint, args.string.pattern, os.path.abspath(args.path), args.dump, args.output,
+                   args.output_size, args.dedup, args.error, args.silence]
+        return hashlib.sha1(json.dumps(options).encode("utf-8")).hexdigest()
+
+    def _log_name(self, generation):
+        return "{}checkpoint-{}.log".format(self.args.output_path, generation)
+
+    def load(self):
+        """Undoes everything written after the last checkpoint and returns it, or None if there is none."""
+        try:
+            with open(self.filename, encoding="utf-8") as fp:
+                state = json.load(fp)
+        except FileNotFoundError:
+            return None
+        if state.get("version") != self.VERSION or state.get("args") != self.fingerprint(self.args):
+            raise ValueError("{} was written by a run with different arguments.".format(self.filename))
+
+        try:
+            with open(self._log_name(state["generation"]), encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        os.remove(line.rstrip("\n"))
+                    except FileNotFoundError:
+                        # Names are logged before their file is created.
+                        pass
+        except FileNotFoundError:
+            pass
+        for name, size in state["outputs"].items():
+            if size is not None:
+                os.truncate(self.args.output_path + name, size)
+            elif os.path.exists(self.args.output_path + name):
+                os.remove(self.args.output_path + name)
+
+        counts.clear()
+        merge_counts(load_counts(state["counts"]))
+        paths.restore(state["paths"])
+        self.done = state["done"]
+        self.file = state["file"]
+        self.offset = state["offset"]
+        self.generation = state["generation"]
+        return state
+
+    def start(self, writer=None):
+        """Saves a first checkpoint, from then on names are logged. writer is the WARCWriter of -dump warc."""
+        self.writer = writer
+        for name in os.listdir(self.args.output_path):
+            if re.fullmatch(r"checkpoint-\d+\.log", name):
+                os.remove(self.args.output_path + name)
+        # A resumed run keeps its place until the next checkpoint, in case it is interrupted again.
+        self.save(self.file, self.offset)
+
+    def resume(self, filename):
+        """Returns the offset to continue filename from, if it was being parsed at the checkpoint."""
+        return self.offset if filename == self.file else None
+
+    def due(self):
+        return time.monotonic() >= self.next
+
+    def finish(self, filename):
+        self.done.append(filename)
+
+    def save(self, filename=None, offset=None):
+        """Checkpoints the run, with offset the next record to parse in filename.
+
+        Must be called between records, with every content file written.
+        """
+        outputs = {}
+        for name in self.OUTPUTS:
+            path = self.args.output_path + name
+            outputs[name] = os.path.getsize(path) if os.path.exists(path) else None
+        state = {
+            "version": self.VERSION,
+            "args": self.fingerprint(self.args),
+            "generation": self.generation + 1,
+            "done": self.done,
+            "file": filename,
+            "offset": offset,
+            "counts": dump_counts(counts),
+            "paths": paths.state(),
+            "warc": self.writer.position() if self.writer is not None else None,
+            "outputs": outputs,
+        }
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=folder, delete=False) as fp:
+            json.dump(state, fp)
+            public_mode(fp)
+        os.replace(fp.name, self.filename)
+
+        # Nothing is allocated while saving, so switching logs after the checkpoint is in place is safe.
+        self.generation += 1
+        old = self.log
+        self.log = paths.log = open(self._log_name(self.generation), "w", encoding="utf-8")
+        if old is not None:
+            old.close()
+            os.remove(old.name)
+        self.next = time.monotonic() + self.args.checkpoint
+
+    def close(self):
+        """Stops logging names. The checkpoint stays, so a finished run resumes to nothing."""
+        paths.log = None
+        if self.log is not None:
+            empty = self.log.tell() == 0
+            self.log.close()
+            if empty:
+                os.remove(self.log.name)
+
+
+def file_summary(args, filename):
+    """Parses filename on its own and returns its counts, leaving the running totals alone."""
+    totals = counts.copy()
+    counts.clear()
+    try:
+        parse_file(args, filename)
+        return counts.copy()
+    finally:
+        counts.clear()
+        counts.update(totals)
+
+
+def warc_files(string, path):
+    """Lists the warc files in path whose name matches string."""
+    return [filename for filename in os.listdir(path)
+            if re.search(string, filename) and ".warc" in filename and not filename.endswith(INDEX_SUFFIX)]
+
+
+def file_records(filename, filters=None, start=None, end=None, use_mmap=False, read_ahead=False, offsets=False,
+                 resume=None):
+    """Iterates over the warc records in filename.
+
+    When filters can be answered from the file's index only the matching
+    records are read, everything else is skipped without touching it.
+    start and end limit the records to those beginning in that range of
+    offsets, see shard_offsets. read_ahead only applies to files read from
+    start to end, as those don't need tell() or seek().
+
+    With offsets the records come as (offset, record) pairs. The offset is
+    None when it can't be told, e.g. while reading ahead. Passing an offset
+    back as resume skips every record before it, see Checkpoint.
+    """
+    indexed = indexed_filters(filters or [])
+    entries = read_index(filename) if indexed else None
+    sharded = start is not None or end is not None
+    members = sharded or (entries is not None and not any(i.get("inflated") for i in entries))
+    read_ahead = read_ahead and not sharded and entries is None and resume is None
+    with WARCFile(filename, members=members, use_mmap=use_mmap, read_ahead=read_ahead) as warc_file:
+        if entries is not None:
+            for offset in sorted(i["offset"] for i in entries if index_match(indexed, i)):
+                if (start is None or offset >= start) and (end is None or offset < end) and \
+                        (resume is None or offset >= resume):
+                    warc_file.seek(offset)
+                    record = warc_file.read_record()
+                    yield (offset, record) if offsets else record
+            return
+
+        if start is not None or resume is not None:
+            # Uncompressed and member compressed files seek, others are decompressed up to the offset.
+            warc_file.seek(max(start or 0, resume or 0))
+        reader = warc_file.reader
+        while True:
+            offset = None
+            if end is not None or (offsets and not read_ahead):
+                reader.finish_reading_current_record()
+                try:
+                    offset = warc_file.tell()
+                except io.UnsupportedOperation:
+                    # Inside a gzip member, so not at a shard boundary yet.
+                    pass
+                if end is not None and offset is not None and offset >= end:
+                    break
+            record = reader.read_record()
+            if record is None:
+                break
+            yield (offset, record) if offsets else record
+
+
+def warc_records(string, path, filters=None):
     """Iterates over warc records in path."""
-    for filename in os.listdir(path):
-        if re.search(string, filename) and ".warc" in filename:
-            print("parsing", filename)
-            with WARCFile(path + filename) as warc_file:
-                for record in warc_file:
-                    yield record
+    for filename in warc_files(string, path):
+        print("parsing", filename)
+        yield from file_records(path + filename, filters)
 
 
 def check_filter(filters, record):
     """Check record against filters."""
-    for i in filters:
-        if i.http:
-            if not record.http:
+    if not isinstance(filters, FilterSet):
+        filters = FilterSet(filters)
+    return filters(record)
+
+
+# ---------------------------------------------------
+#                 Index                            -
+# ---------------------------------------------------
+INDEX_SUFFIX = ".cdxj"
+GZIP_MAGIC = b"\x1f\x8b\x08"
+
+# Filters that can be answered from an index entry, mapped to the entry field holding the value.
+INDEX_FIELDS = {
+    (False, "warc-type"): "warc-type",
+    (False, "content-type"): "warc-content-type",
+    (False, "warc-target-uri"): "url",
+    (False, "warc-payload-digest"): "digest",
+    (False, "host"): "url",
+    (False, "path"): "url",
+    (True, "content-type"): "mime",
+    (True, "error"): "status",
+}
+
+
+def surt(url):
+    """Returns the sort friendly url key used by cdx indexes.
+
+        >>> surt("http://www.Example.com/a/b?c=1")
+        'com,example)/a/b?c=1'
+    """
+    if not url:
+        return "-"
+    parts = urlparse(url)
+    host = (parts.hostname or "").replace("www.", "", 1)
+    key = ",".join(reversed(host.split("."))) + ")" + (parts.path or "/")
+    if parts.query:
+        key += "?" + parts.query
+    return key
+
+
+def index_entry(record):
+    """Collects the indexed fields of a record."""
+    entry = {
+        "url": record.url,
+        "digest": record.checksum,
+        "warc-type": record.header.get("warc-type"),
+        "warc-content-type": record.header.get("content-type"),
+    }
+    try:
+        if record.http:
+            entry["mime"] = record.http.get("content-type")
+            entry["status"] = record.http.get("error")
+    except ValueError:
+        # Let the full parser deal with broken HTTP blocks, see index_match.
+        entry["http-error"] = True
+    return {k: v for k, v in entry.items() if v is not None}
+
+
+def is_record_gzip(filename, limit=None):
+    """Checks that every record of a gzip compressed warc file is a gzip member of its own.
+
+    Only such files support reading a record by compressed offset. When limit
+    is given only the first limit records are checked.
+    """
+    with WARCFile(filename, members=True) as warc_file:
+        reader = warc_file.reader
+        count = 0
+        while limit is None or count < limit:
+            reader.finish_reading_current_record()
+            try:
+                warc_file.tell()
+            except io.UnsupportedOperation:
                 return False
-            value = record.http
-        else:
-            value = record.header
+            if reader.read_record() is None:
+                break
+            count += 1
+    return True
 
-        string = value.get(i.k, None)
-        if not string or (i.v in string) != i.result:
+
+def find_record_member(fileobj, start, stop, window=1 << 20):
+    """Finds the first gzip member beginning in [start, stop) that starts a warc record.
+
+    Candidates are found by the gzip magic bytes and confirmed by
+    decompressing the beginning of the member. Returns None if there is none.
+    """
+    lookahead = 1 << 16
+    offset = start
+    while offset < stop:
+        fileobj.seek(offset)
+        data = fileobj.read(window + lookahead)
+        limit = min(window, stop - offset, len(data))
+        pos = data.find(GZIP_MAGIC, 0, limit + len(GZIP_MAGIC) - 1)
+        while pos != -1:
+            try:
+                if zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(data[pos:pos + lookahead], 5) == b"WARC/":
+                    return offset + pos
+            except zlib.error:
+                pass
+            pos = data.find(GZIP_MAGIC, pos + 1, limit + len(GZIP_MAGIC) - 1)
+        if len(data) < window + lookahead:
+            break
+        offset += window
+    return None
+
+
+def shard_offsets(filename, count):
+    """Returns up to count - 1 record offsets splitting filename into shards of similar size.
+
+    Offsets come from the file's index when there is one. Otherwise gzip files
+    with one member per record are scanned for members near the split points.
+    Files that can't be split return an empty list.
+    """
+    size = os.path.getsize(filename)
+    targets = [size * n // count for n in range(1, count)]
+    entries = read_index(filename)
+    if entries and not any(i.get("inflated") for i in entries):
+        offsets = sorted(i["offset"] for i in entries)
+        found = [offsets[bisect.bisect_left(offsets, i)] for i in targets if i <= offsets[-1]]
+    elif filename.endswith(".gz") and is_record_gzip(filename, limit=2):
+        with open(filename, "rb") as fp:
+            found = [find_record_member(fp, i, i + size // count) for i in targets]
+    else:
+        return []
+    return sorted(set(i for i in found if i))
+
+
+def build_index(filename):
+    """Writes a sorted CDXJ index of every record in filename next to it.
+
+    Offsets into gzip files are compressed member offsets, unless the records
+    are not gzipped one per member. Those files fall back to offsets into the
+    decompressed stream and mark their entries as inflated.
+    """
+    try:
+        lines = _index_lines(filename, members=True)
+    except io.UnsupportedOperation:
+        lines = _index_lines(filename, members=False)
+
+    lines.sort()
+    with open(filename + INDEX_SUFFIX, "w", encoding="utf-8") as fp:
+        fp.writelines(lines)
+
+
+def _index_lines(filename, members):
+    lines = []
+    with WARCFile(filename, members=members) as warc_file:
+        inflated = getattr(warc_file.fileobj, "inflated", False)
+        reader = warc_file.reader
+        offset = warc_file.tell()
+        record = reader.read_record()
+        while record is not None:
+            entry = index_entry(record)
+            reader.finish_reading_current_record()
+            end = warc_file.tell()
+            entry["offset"] = offset
+            entry["length"] = end - offset
+            entry["filename"] = os.path.basename(filename)
+            if inflated:
+                entry["inflated"] = True
+            timestamp = re.sub(r"\D", "", record.date or "")[:14] or "-"
+            lines.append("{} {} {}\n".format(surt(record.url), timestamp, json.dumps(entry, sort_keys=True)))
+            offset = end
+            record = reader.read_record()
+    return lines
+
+
+def read_index(filename):
+    """Returns the index entries of filename, or None if it has no up to date index."""
+    index = filename + INDEX_SUFFIX
+    try:
+        if os.path.getmtime(index) < os.path.getmtime(filename):
+            return None
+        with open(index, encoding="utf-8") as fp:
+            return [json.loads(line.split(" ", 2)[2]) for line in fp]
+    except OSError:
+        return None
+
+
+def indexed_filters(filters):
+    """Returns the filters that can be answered from an index."""
+    return [i for i in filters if (i.http, i.k) in INDEX_FIELDS]
+
+
+def index_match(filters, entry):
+    """Check index entry against filters, the index equivalent of check_filter."""
+    for i in filters:
+        if i.http and entry.get("http-error"):
+            # Can't decide without parsing the record, let check_filter do it.
+            continue
+        if not i.match(entry.get(INDEX_FIELDS[(i.http, i.k)])):
             return False
     return True
 
 
-def parse(args):
-    # Clear output warc file.
-    if args.dump == "warc":
-        if args.silence:
-            print("Recording", args.dump, "to", args.output + ".")
-        with open(args.output_path + args.output, "wb"):
-            pass
+class ContentArchive:
+    """Writes -dump content files into tar or zip archives instead of folders.
 
-    for record in warc_records(args.string, args.path):
-        try:
-            # Filter out unwanted entries.
-            if not check_filter(args.filter, record):
-                continue
+    The format follows the extension of filename: .tar, .tar.gz or .tgz,
+    .tar.bz2, .tar.xz or .zip. Files keep the host/path layout -dump content
+    uses on disk. With max_size set a new numbered archive, e.g.
+    content-00001.tar.gz, is started once the current one has reached
+    max_size bytes.
+    """
+    FORMATS = {".tar": "w|", ".tar.gz": "w|gz", ".tgz": "w|gz", ".tar.bz2": "w|bz2", ".tar.xz": "w|xz", ".zip": None}
+
+    def __init__(self, filename, max_size=None):
+        self.ext = self.extension(filename)
+        if self.ext is None:
+            raise ValueError("Unknown archive format: %r" % filename)
+        self.stem = filename[:-len(self.ext)]
+        self.max_size = max_size
+        self.number = 0
+        self.paths = PathAllocator(on_disk=False)
+        self._open()
+
+    @classmethod
+    def extension(cls, filename):
+        """Returns the archive extension filename ends with, or None if it isn't one."""
+        for ext in sorted(cls.FORMATS, key=len, reverse=True):
+            if filename.endswith(ext):
+                return ext
+        return None
+
+    def _open(self):
+        name = self.stem + (self.ext if self.number == 0 else "-{:05d}{}".format(self.number, self.ext))
+        self.fileobj = open(name, "wb", buffering=CHUNK_SIZE)
+        if self.FORMATS[self.ext] is None:
+            self.archive = zipfile.ZipFile(self.fileobj, "w", zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(fileobj=self.fileobj, mode=self.FORMATS[self.ext])
 
-            # Increment Index counters.
-            if args.silence:
-                inc("records")
-                inc(record, "warc-type", "types")
-                inc(record, "content_type", "warc-content")
-                if record.http:
-                    inc(record.http, "content_type", "http-content")
-                    inc(record.http, "error", "status")
-
-            # Dump records to file.
-            if args.dump == "warc":
-                with open(args.output_path + args.output, "ab") as output:
-                    record.write_to(output)
-
-            if args.dump == "content":
-                url = urlparse(unquote(record['WARC-Target-URI']))
-
-                # Set up folder
-                index = url.path.rfind("/") + 1
-                file = url.path[index:]
-                path = url.path[:index]
-
-                # Process filename
-                if "." not in file:
-                    path += file
-                    if not path.endswith("/"):
-                        path += "/"
-
-                    file = 'index.html'
-
-                # Final fixes.
-                path = path.replace(".", "-")
-                host = url.hostname.replace('www.', '', 1)
-                path = args.output_path + host + path
-
-                # Create new directories
-                if not os.path.exists(path):
-                    try:
-                        os.makedirs(path)
-                    except OSError:
-                        path = "/".join([i[:25] for i in path.split("/")])
-                        os.makedirs(path)
-
-                # Test if file has a proper extension.
-                index = file.index(".")
-                suffix = file[index:]
-                content = record.http.get("content_type", "")
-                slist = mimetypes.guess_all_extensions(content)
-                if suffix not in slist:
-                    # Correct suffix if we can.
-                    suffix = mimetypes.guess_extension(content)
-                    if suffix:
-                        file = file[:index] + suffix
-                    else:
-                        inc(record.http, "content_type", "unknown mime type")
+    def close(self):
+        self.archive.close()
+        self.fileobj.close()
 
-                # Check for gzip compression.
-                if record.http.get("content-encoding", None) == "gzip":
-                    file += ".gz"
+    def add(self, record, path, file):
+        """Adds the content of record as file in folder path, numbering it if the name is taken."""
+        if self.max_size and self.fileobj.tell() >= self.max_size:
+            self.close()
+            self.number += 1
+            self._open()
 
-                path += file
+        name = self.paths.allocate(path, file)
+        try:
+            date = datetime.datetime.fromisoformat((record.date or "").replace("Z", "+00:00"))
+        except ValueError:
+            date = datetime.datetime(1980, 1, 1, tzinfo=datetime.timezone.utc)
+
+        if isinstance(self.archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, max(date.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with self.archive.open(info, "w", force_zip64=True) as fp:
+                record.http.write_payload_to(fp)
+            return
+
+        # Tar needs the size up front, so large payloads are spooled to disk first.
+        with tempfile.SpooledTemporaryFile(CHUNK_SIZE) as buffer:
+            record.http.write_payload_to(buffer)
+            info = tarfile.TarInfo(name)
+            info.size = buffer.tell()
+            # A whole number keeps tarfile from adding a pax header to every file.
+            info.mtime = int(date.replace(tzinfo=date.tzinfo or datetime.timezone.utc).timestamp())
+            buffer.seek(0)
+            self.archive.addfile(info, buffer)
+
+
+class ContentWriter:
+    """Writes -dump content files on a pool of threads.
+
+    The caller decodes each payload into a buffer, kept in memory or spooled
+    to a temporary file when it is large, and the pool creates and writes the
+    files. Once max_pending files are waiting submit() blocks, so parsing
+    can't get far ahead of writing. Errors are reported in the order the
+    files were submitted and name the record they belong to.
+    """
+
+    def __init__(self, threads, max_pending=64):
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = collections.deque()
 
-                # If Duplicate file then insert numbers
-                index = path.rfind(".")
-                temp = path
-                n = 0
-                while os.path.isfile(temp):
-                    n += 1
-                    temp = path[:index] + "(" + str(n) + ")" + path[index:]
-                path = temp
+    def submit(self, record, path, file):
+        """Decodes the payload of record and queues writing it to a free name for file in folder path."""
+        buffer = tempfile.SpooledTemporaryFile(CHUNK_SIZE)
+        try:
+            record.http.write_payload_to(buffer)
+        except BaseException:
+            buffer.close()
+            raise
+        buffer.seek(0)
+
+        self.slots.acquire()
+        future = self.pool.submit(self._write, buffer, path, file, paths.allocate(path, file))
+        future.add_done_callback(lambda _: self.slots.release())
+        self.pending.append((record, future))
+        self.report(wait=False)
 
-                # Write file.
+    @staticmethod
+    def _write(buffer, path, file, name):
+        with buffer:
+            while True:
                 try:
-                    with open(path, 'wb') as fp:
-                        record.http.write_payload_to(fp)
-                except OSError as e:
-                    print("unable to save file due to operating system error:", e)
+                    fp = open(name, 'xb')
+                    break
+                except FileExistsError:
+                    # Taken by another process since the folder was listed.
+                    name = paths.allocate(path, file)
+            with fp:
+                shutil.copyfileobj(buffer, fp, CHUNK_SIZE)
+
+    def report(self, wait=True):
+        """Reports the errors of finished writes in order, waiting for all of them unless wait is False."""
+        while self.pending and (wait or self.pending[0][1].done()):
+            record, future = self.pending.popleft()
+            try:
+                future.result()
+            except OSError as e:
+                print("unable to save file due to operating system error:", e,
+                      "record:", record.header.get("WARC-Record-ID"), record.url)
+            except Exception as e:
+                # Anything else from a write only concerns its own record, the run carries on.
+                print("unable to save file:", repr(e), "record:", record.header.get("WARC-Record-ID"), record.url)
 
-        except Exception:
-            if args.error:
-                if args.silence:
-                    print("Error in record. Recording to error.warc.")
-                with open(args.output_path + "error.warc", "ab") as fp:
-                    record.write_to(fp)
-            else:
+    def close(self):
+        self.report()
+        self.pool.shutdown()
+
+
+class HashingFile:
+    """Passes writes on to fp while computing their SHA-1 digest."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.hash = hashlib.sha1()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.fp.write(data)
+
+    @property
+    def digest(self):
+        """The digest in the form used by WARC-Payload-Digest."""
+        return "sha1:" + base64.b32encode(self.hash.digest()).decode()
+
+
+def object_path(output_path, digest):
+    """Returns where the content with the given payload digest is stored, e.g. objects/sha1/AB/ABCD..."""
+    algorithm, _, value = digest.partition(":")
+    value = re.sub(r"[^\w\-]", "_", value or algorithm)
+    return os.path.join(output_path, "objects", re.sub(r"[^\w\-]", "_", algorithm.lower()), value[:2], value)
+
+
+def store_content(args, record, path, file, part=""):
+    """Writes the content of record once per payload digest and makes file in folder path refer to it.
+
+    Content is stored under objects/ by its WARC-Payload-Digest, or by the
+    SHA-1 of the extracted file when the record has none, and is only
+    written the first time that digest is seen. With args.dedup 'link' the
+    file becomes a hard link to the stored file, with 'manifest' it is only
+    listed in manifest.jsonl plus part.
+    """
+    digest = record.header.get("warc-payload-digest")
+    stored = digest and object_path(args.output_path, digest)
+    if stored and os.path.exists(stored):
+        inc("duplicate content")
+    else:
+        store = os.path.join(args.output_path, "objects")
+        os.makedirs(store, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=store, prefix="tmp-", delete=False) as fp:
+            # Logged so that -resume removes it when the run stops before it is renamed.
+            paths.note(fp.name)
+            try:
+                hashing = HashingFile(fp)
+                record.http.write_payload_to(hashing)
+                public_mode(fp)
+            except BaseException:
+                os.remove(fp.name)
                 raise
+        stored = stored or object_path(args.output_path, hashing.digest)
+        if os.path.exists(stored):
+            inc("duplicate content")
+        else:
+            paths.note(stored)
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        # Another worker may have stored the same content meanwhile, either copy will do.
+        os.replace(fp.name, stored)
+
+    if args.dedup == "manifest":
+        entry = {"url": record.url, "path": os.path.relpath(paths.allocate(path, file, create=False), args.output_path),
+                 "object": os.path.relpath(stored, args.output_path)}
+        with open(args.output_path + "manifest.jsonl" + part, "a", encoding="utf-8") as fp:
+            fp.write(json.dumps(entry, sort_keys=True) + "\n")
+        return
+
+    while True:
+        try:
+            os.link(stored, paths.allocate(path, file))
+            return
+        except FileExistsError:
+            # Taken by another process since the folder was listed.
+            pass
+
+
+def write_content(record, path, file):
+    """Writes the content of record to a free name for file in folder path."""
+    # Exclusive creation keeps parallel workers from claiming the same name.
+    while True:
+        try:
+            fp = open(paths.allocate(path, file), 'xb')
+            break
+        except FileExistsError:
+            # Taken by another process since the folder was listed.
+            pass
+    with fp:
+        record.http.write_payload_to(fp)
+
+
+def parse_file(args, filename, writer=None, part="", start=None, end=None, checkpoint=None):
+    """Filters, counts and dumps the records of a single warc file.
+
+    Warc output, or content output when writing to archives, goes to writer
+    and error.warc plus part, so that parallel workers can each write their
+    own part file. start and end restrict parsing to one shard of the file.
+    checkpoint is saved between records every now and then, and tells where
+    to resume the file.
+    """
+    resume = checkpoint.resume(filename) if checkpoint is not None else None
+    if resume is not None:
+        print("resuming", filename, "from offset", resume)
+    elif start is None:
+        print("parsing", filename)
+    else:
+        print("parsing", filename, "from offset", start)
+    content_writer = None
+    if args.dump == "content" and args.writers > 0 and not isinstance(writer, ContentArchive):
+        content_writer = ContentWriter(args.writers)
+    records = file_records(args.path + filename, args.filter, start, end, args.mmap,
+                           args.pipeline and checkpoint is None, offsets=True, resume=resume)
+    if stats is not None:
+        size = os.path.getsize(args.path + filename)
+        stats.begin(filename, (end or size) - (start or resume or 0))
+        records = stats.iterate(records)
+    try:
+        for offset, record in records:
+            if checkpoint is not None and offset is not None and checkpoint.due():
+                if content_writer is not None:
+                    content_writer.report()
+                checkpoint.save(filename, offset)
+
+            try:
+                # Filter out unwanted entries.
+                if stats is not None:
+                    stats.switch("filter")
+                if not check_filter(args.filter, record):
+                    continue
+
+                # Increment Index counters.
+                if stats is not None:
+                    stats.switch("count")
+                if args.silence:
+                    inc("records")
+                    inc(record, "warc-type", "types")
+                    inc(record, "content_type", "warc-content")
+                    if record.http:
+                        inc(record.http, "content_type", "http-content")
+                        inc(record.http, "error", "status")
+
+                # Dump records to file.
+                if stats is not None:
+                    stats.switch("write")
+                if args.dump == "warc":
+                    writer.write_record(record)
+
+                if args.dump == "content":
+                    url = urlparse(unquote(record['WARC-Target-URI']))
+
+                    # Set up folder
+                    index = url.path.rfind("/") + 1
+                    file = url.path[index:]
+                    path = url.path[:index]
+
+                    # Process filename
+                    if "." not in file:
+                        path += file
+                        if not path.endswith("/"):
+                            path += "/"
+
+                        file = 'index.html'
+
+                    # Final fixes.
+                    path = path.replace(".", "-")
+                    host = url.hostname.replace('www.', '', 1)
+                    path = args.output_path + host + path
+
+                    # Create new directories
+                    if isinstance(writer, ContentArchive):
+                        path = path[len(args.output_path):]
+                    elif args.dedup != "manifest":
+                        try:
+                            paths.folder(path)
+                        except OSError:
+                            path = "/".join([i[:25] for i in path.split("/")])
+                            paths.folder(path)
+
+                    # Test if file has a proper extension.
+                    index = file.index(".")
+                    suffix = file[index:]
+                    content = record.http.get("content_type", "")
+                    slist = mimetypes.guess_all_extensions(content)
+                    if suffix not in slist:
+                        # Correct suffix if we can.
+                        suffix = mimetypes.guess_extension(content)
+                        if suffix:
+                            file = file[:index] + suffix
+                        else:
+                            inc(record.http, "content_type", "unknown mime type")
+
+                    # Mark content encodings that can't be decoded.
+                    file += record.http.body_suffix()
+
+                    # Write file, if duplicate file then insert numbers.
+                    try:
+                        if isinstance(writer, ContentArchive):
+                            writer.add(record, path, file)
+                            continue
+                        if args.dedup:
+                            store_content(args, record, path, file, part)
+                            continue
+                        if content_writer is not None:
+                            content_writer.submit(record, path, file)
+                            continue
+                        write_content(record, path, file)
+                    except OSError as e:
+                        print("unable to save file due to operating system error:", e)
+
+            except Exception:
+                if args.error:
+                    if args.silence:
+                        print("Error in record. Recording to error.warc.")
+                    with open(args.output_path + "error.warc" + part, "ab") as fp:
+                        record.write_to(fp)
+                else:
+                    raise
+    finally:
+        # Queued writes are reported even when a record stops the run.
+        if content_writer is not None:
+            content_writer.close()
+    if stats is not None:
+        stats.end()
+
+
+def _parse_job(args, job, part):
+    """Runs parse_file in a worker process.
+
+    Hands back its counts, the sizes of the records it dumped, stats and the
+    content file names it staged, see StagingAllocator.
+    """
+    global stats, paths
+    counts.clear()
+    stats = Stats() if args.stats or args.progress else None
+    writer = None
+    if args.dump == "warc":
+        writer = WARCWriter(args.output_path + args.output + part, compress=args.output.endswith(".gz"), sizes=True,
+                            threaded=args.pipeline)
+    elif args.dump == "content":
+        paths = StagingAllocator(args.output_path + "staging" + part + "/")
+        os.makedirs(paths.staging, exist_ok=True)
+    try:
+        parse_file(args, job[0], writer, part, job[1], job[2])
+    finally:
+        if writer is not None:
+            writer.close()
+    names = paths.names if isinstance(paths, StagingAllocator) else None
+    return dict(counts), writer.sizes if isinstance(writer, WARCWriter) else None, stats and stats.report(), names
+
+
+def place_staged(args, names, part):
+    """Moves the content files of a -workers job from staging to the names a sequential run gives them.
+
+    Must be called for the jobs in order. Names that were handed out but not
+    written still take their number, like they do in a sequential run.
+    """
+    final = {}
+    for path, file, create, staged in names:
+        name = paths.allocate(path, file, create)
+        final[os.path.relpath(staged, args.output_path)] = os.path.relpath(name, args.output_path)
+        if create and os.path.lexists(staged):
+            os.replace(staged, name)
+    shutil.rmtree(args.output_path + "staging" + part, ignore_errors=True)
+
+    # Manifest entries list the staged names.
+    manifest = args.output_path + "manifest.jsonl" + part
+    if os.path.exists(manifest):
+        with open(manifest, encoding="utf-8") as fp, open(manifest + ".tmp", "w", encoding="utf-8") as output:
+            for line in fp:
+                entry = json.loads(line)
+                entry["path"] = final[entry["path"]]
+                output.write(json.dumps(entry, sort_keys=True) + "\n")
+        os.replace(manifest + ".tmp", manifest)
+
+
+def plan_jobs(args, files):
+    """Splits files into (filename, start, end) jobs for args.workers processes.
+
+    Files much larger than their share of the total are split into shards, so
+    a single huge file still keeps every worker busy.
+    """
+    sizes = [os.path.getsize(args.path + i) for i in files]
+    share = max(sum(sizes) // args.workers, 1)
+    jobs = []
+    for filename, size in zip(files, sizes):
+        offsets = shard_offsets(args.path + filename, -(-size // share)) if size > share else []
+        for start, end in zip([None] + offsets, offsets + [None]):
+            jobs.append((filename, start, end))
+    return jobs
+
+
+def _join_parts(filename, parts):
+    """Appends the part files written by workers to filename in order."""
+    for part in parts:
+        if os.path.exists(part):
+            with open(filename, "ab") as output, open(part, "rb") as fp:
+                shutil.copyfileobj(fp, output)
+            os.remove(part)
+
+
+def parse(args):
+    global stats
+    checkpoint = state = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(args)
+        if args.resume:
+            state = checkpoint.load()
+            if state is None:
+                print("No checkpoint found, starting from the beginning.")
+
+    # Clear output warc file, unless resuming.
+    writer = None
+    if args.dump == "warc":
+        if args.silence:
+            print("Recording", args.dump, "to", args.output + ".")
+        writer = WARCWriter(args.output_path + args.output, max_size=args.output_size and args.output_size << 20,
+                            threaded=args.pipeline, resume=state and state["warc"])
+    elif args.dump == "content" and args.archive:
+        writer = ContentArchive(args.output_path + args.archive, max_size=args.output_size and args.output_size << 20)
+
+    # Only plain summaries come from the cache, dumps always read the records.
+    cache = None
+    if args.cache:
+        cache = SummaryCache(args.cache)
+        if args.cache_clear:
+            cache.clear()
+        if args.cache_prune:
+            print("pruned", cache.prune(), "files from the cache.")
+        if args.dump or not args.silence:
+            cache.save()
+            cache = None
+
+    try:
+        files = warc_files(args.string, args.path)
+        summaries = {}
+        if cache is not None:
+            for filename in files:
+                summary = cache.get(args.path + filename, args.filter.fingerprint)
+                if summary is not None:
+                    print("summary of", filename, "from cache")
+                    summaries[filename] = summary
+            parsed = [i for i in files if i not in summaries]
+        else:
+            parsed = files
+
+        stats = None
+        if args.stats or args.progress:
+            stats = Stats(args.progress, sum(os.path.getsize(args.path + i) for i in parsed))
+
+        if args.workers > 1:
+            # Every job writes its own part files which are joined in order afterwards,
+            # so the output matches a sequential run.
+            jobs = plan_jobs(args, parsed)
+            parts = [".part{}".format(n) for n in range(len(jobs))]
+            with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+                results = pool.map(_parse_job, itertools.repeat(args), jobs, parts)
+                for job, part, (result, sizes, report, names) in zip(jobs, parts, results):
+                    if report is not None:
+                        stats.merge(report)
+                    if cache is not None:
+                        # Shards of a file add up to the counts of the whole file.
+                        merge_counts(result, summaries.setdefault(job[0], {}))
+                    else:
+                        merge_counts(result)
+                    if sizes is not None:
+                        writer.append(args.output_path + args.output + part, sizes)
+                        os.remove(args.output_path + args.output + part)
+                    if names is not None:
+                        place_staged(args, names, part)
+            for name in ("error.warc", "manifest.jsonl"):
+                _join_parts(args.output_path + name, [args.output_path + name + i for i in parts])
+        elif cache is not None:
+            for filename in parsed:
+                summaries[filename] = file_summary(args, filename)
+        else:
+            if checkpoint is not None:
+                checkpoint.start(writer)
+            for filename in parsed:
+                if checkpoint is None:
+                    parse_file(args, filename, writer)
+                elif filename not in checkpoint.done:
+                    parse_file(args, filename, writer, checkpoint=checkpoint)
+                    checkpoint.finish(filename)
+            if checkpoint is not None:
+                checkpoint.save()
+
+        if cache is not None:
+            for filename in files:
+                summary = summaries.get(filename, {})
+                if filename in parsed:
+                    cache.put(args.path + filename, args.filter.fingerprint, summary)
+                merge_counts(summary)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+        if writer is not None:
+            writer.close()
+        if cache is not None:
+            cache.save()
+
+    if args.stats:
+        report = stats.report()
+        report["counts"] = dump_counts(counts)
+        with open(args.stats, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=1)
 
     # print results
     if args.silence:
@@ -820,12 +3161,153 @@ def parse(args):
             pprint(counts[i])
 
 
+# ---------------------------------------------------
+#                 Profile                          -
+# ---------------------------------------------------
+
+# Functions whose time -profile reports as a stage of parsing.
+PROFILE_STAGES = [
+    ("decompress", [GzipMemberFile._feed]),
+    ("readline", [StreamBuffer.readuntil, MmapBuffer.readuntil, FilePart.readuntil]),
+    ("warc header", [WARCReader.read_header]),
+    ("http header", [HTTPObject._read_headers, HTTPObject._split_headers]),
+    ("filter", [check_filter]),
+    ("write", [WARCWriter.write_record, HTTPObject.write_payload_to, HTTPObject.body_suffix, write_content,
+               store_content, ContentWriter.submit, ContentArchive.add, PathAllocator.folder, PathAllocator.allocate]),
+]
+
+
+def profile_key(code):
+    """Returns the (filename, line, name) key that profilers use for the function of code."""
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def profile_label(key):
+    filename, line, name = key
+    if filename == "~":
+        return name
+    return "{}:{}({})".format(os.path.basename(filename), line, name)
+
+
+class SamplingProfiler:
+    """Low overhead alternative to cProfile for -profile_mode sample.
+
+    A background thread looks at the stack of the profiled thread every
+    interval seconds and counts what it finds. Nothing runs in the profiled
+    thread itself, so the run keeps its normal speed, at the price of only
+    estimating times and not counting calls. Samples can only be taken when
+    the profiled thread lets go of the GIL, which favours code that releases
+    it, like decompressing. Stacks are saved in the collapsed format read by
+    flame graph tools.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.thread = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def enable(self):
+        self.thread = threading.get_ident()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._run, daemon=True)
+        self._sampler.start()
+
+    def disable(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread)
+            stack = []
+            while frame is not None:
+                stack.append(profile_key(frame.f_code))
+                frame = frame.f_back
+            self.stacks[tuple(stack)] += 1
+
+    def dump_stats(self, filename):
+        with open(filename, "w", encoding="utf-8") as fp:
+            for stack, n in self.stacks.most_common():
+                fp.write("{} {}\n".format(";".join(profile_label(i) for i in reversed(stack)), n))
+
+    def summary(self, stages, elapsed):
+        """Returns the seconds per stage and per function, with every sample counted for its innermost stage.
+
+        elapsed is shared out in proportion to the samples, as fewer samples
+        than one per interval are taken.
+        """
+        times = collections.Counter()
+        functions = collections.Counter()
+        share = elapsed / max(sum(self.stacks.values()), 1)
+        for stack, n in self.stacks.items():
+            functions[stack[0]] += n * share
+            times[next((stages[i] for i in stack if i in stages), "other")] += n * share
+        return times, [(key, None, seconds, None) for key, seconds in functions.most_common()]
+
+
+def cprofile_summary(profiler, stages):
+    """Returns the cumulative seconds per stage and (key, calls, own seconds, cumulative seconds) per function.
+
+    Calls between functions of the same stage are only counted once.
+    """
+    data = pstats.Stats(profiler).stats
+    times = collections.Counter()
+    for key, (calls, _, own, total, callers) in data.items():
+        stage = stages.get(key)
+        if stage is not None:
+            times[stage] += total - sum(i[3] for caller, i in callers.items() if stages.get(caller) == stage)
+    functions = sorted(((key, i[1], i[2], i[3]) for key, i in data.items()), key=lambda i: i[2], reverse=True)
+    return times, functions
+
+
+def print_profile(times, functions, elapsed, top=20):
+    stages = [name for name, _ in PROFILE_STAGES] + ["other"]
+    print("-----------------------------")
+    print("{:<14}{:>10}{:>8}".format("stage", "seconds", "%"))
+    for name in stages:
+        if name in times:
+            print("{:<14}{:>10.3f}{:>8.1f}".format(name, times[name], 100 * times[name] / elapsed))
+    print("\nTop {} functions by own time.".format(top))
+    print("{:>10}{:>10}{:>10}  {}".format("calls", "own", "total", "function"))
+    for key, calls, own, total in functions[:top]:
+        print("{:>10}{:>10.3f}{:>10}  {}".format("-" if calls is None else calls, own,
+                                                "-" if total is None else "{:.3f}".format(total), profile_label(key)))
+
+
+def profile_parse(args):
+    """Runs parse() under a profiler, saves the profile to args.profile and prints where the time went.
+
+    Only the main process is profiled, not -workers processes.
+    """
+    profiler = SamplingProfiler() if args.profile_mode == "sample" else cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        parse(args)
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - started
+        profiler.dump_stats(args.profile)
+        stages = {profile_key(function.__code__): name for name, functions in PROFILE_STAGES for function in functions}
+        if args.profile_mode == "sample":
+            times, functions = profiler.summary(stages, elapsed)
+        else:
+            times, functions = cprofile_summary(profiler, stages)
+        print_profile(times, functions, elapsed)
+        if args.profile_mode != "sample":
+            print("\nStage times are cumulative, e.g. readline includes decompressing what it reads.")
+
+
 def main():
     parser = argparse.ArgumentParser(description='Extracts attributes from warc files.')
     parser.add_argument("filter", nargs='*',
                         help="Attributes to filter by. Entries that do not contain filtered elements are ignored. "
                              "Example: warc-type:response, would ignore all warc entries that are not responses. "
-                             "Attributes in an HTTP object should be prefixed by 'http'. Example, http:error:200.")
+                             "Attributes in an HTTP object should be prefixed by 'http'. Example, http:error:200. "
+                             "Values can also be numeric comparisons like http:error:>=400, ranges like 200..299 or "
+                             "regular expressions starting with ~. host and path match parts of the target uri.")
     parser.add_argument("-silence", action="store_false", help="Silences output of warc data.")
     parser.add_argument("-error", action="store_true",
                         help="Silences most errors and records problematic warc entries to error.warc.")
@@ -836,9 +3318,61 @@ def main():
                         help="Path to folder to dump content files. Defaults to data/ folder.")
     parser.add_argument("-output", default="output.warc",
                         help="File to output warc contents. Defaults to 'output.warc'.")
+    parser.add_argument("-output_size", type=int,
+                        help="Starts a new output warc file, or -archive, every time the current one reaches this "
+                             "many megabytes. Output files ending in .gz are gzipped one record at a time.")
     parser.add_argument("-dump", choices=['warc', 'content'], type=str,
                         help="Dumps all entries that survived filter. 'warc' creates a filtered warc file. "
                              "'content' tries to reproduce file structure of archived websites.")
+    parser.add_argument("-dedup", choices=['link', 'manifest'],
+                        help="With '-dump content' stores every distinct payload once under objects/, keyed by its "
+                             "payload digest. 'link' hard links the extracted files to it, 'manifest' lists them in "
+                             "manifest.jsonl instead.")
+    parser.add_argument("-archive",
+                        help="With '-dump content' writes the files into this archive in the output folder instead "
+                             "of separate files. Supported formats are .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz and "
+                             ".zip. -output_size starts new numbered archives.")
+    parser.add_argument("-writers", type=int, default=0,
+                        help="Number of threads writing -dump content files while parsing goes on. "
+                             "Defaults to 0, which writes every file before reading the next record.")
+    parser.add_argument("-workers", type=int, default=1,
+                        help="Number of processes parsing warc files in parallel. Defaults to 1.")
+    parser.add_argument("-pipeline", action="store_true",
+                        help="Reads and decompresses warc files on a background thread while records are parsed, "
+                             "and writes -dump warc output on another.")
+    parser.add_argument("-mmap", action="store_true",
+                        help="Memory maps uncompressed warc files instead of reading them, "
+                             "which avoids copying record payloads.")
+    parser.add_argument("-cache",
+                        help="File keeping the counts of every warc file between runs. Summaries without -dump "
+                             "only parse files that are new or changed since they were cached.")
+    parser.add_argument("-cache_clear", action="store_true", help="Empties the -cache before running.")
+    parser.add_argument("-cache_prune", action="store_true",
+                        help="Removes files that were deleted or changed from the -cache before running.")
+    parser.add_argument("-checkpoint", type=int,
+                        help="Saves the progress of the run to checkpoint.json in the output folder every this many "
+                             "seconds, so that it can be continued with -resume.")
+    parser.add_argument("-resume", action="store_true",
+                        help="Continues an interrupted run from its last checkpoint, leaving the output as if it had "
+                             "not been interrupted. Needs the same arguments as the interrupted run.")
+    parser.add_argument("-stats",
+                        help="Writes a JSON report of the run to this file: records and bytes per second for every "
+                             "warc file, the time spent decompressing, parsing headers, parsing HTTP, filtering, "
+                             "counting and writing, and the peak memory use.")
+    parser.add_argument("-progress", type=int,
+                        help="Prints the progress of the run, its speed and the estimated time left every this many "
+                             "seconds.")
+    parser.add_argument("-profile",
+                        help="Profiles the run and saves the profile to this file, a pstats file that can be read "
+                             "with python -m pstats, then prints the time spent in each stage of parsing and the "
+                             "slowest functions.")
+    parser.add_argument("-profile_mode", choices=["cprofile", "sample"], default="cprofile",
+                        help="'cprofile' traces every call. 'sample' looks at the running code every 5ms instead, "
+                             "which slows the run down much less, and saves collapsed stacks for flame graphs.")
+    parser.add_argument("-index", action="store_true",
+                        help="Writes a CDXJ index next to each warc file instead of extracting. Later runs use the "
+                             "index to read only the records matching warc-type, content-type, warc-target-uri, "
+                             "warc-payload-digest, host, path, http:content-type and http:error filters.")
     args = parser.parse_args()
 
     if args.path[-1] != "/":
@@ -847,7 +3381,21 @@ def main():
     if args.output_path[-1] != "/":
         args.output_path += "/"
 
-    if args.dump:
+    if args.archive and ContentArchive.extension(args.archive) is None:
+        parser.error("-archive must end in one of " + ", ".join(ContentArchive.FORMATS))
+    if args.archive and args.dedup:
+        parser.error("-archive and -dedup can't be used together")
+    if args.archive and args.workers > 1:
+        # Names are numbered apart by each process on its own, archives written in parallel could repeat them.
+        parser.error("-archive can't be used with -workers")
+    if (args.cache_clear or args.cache_prune) and not args.cache:
+        parser.error("-cache_clear and -cache_prune need a -cache file")
+    if args.resume and not args.checkpoint:
+        args.checkpoint = 60
+    if args.checkpoint and (args.workers > 1 or args.archive or args.cache):
+        parser.error("-checkpoint and -resume can't be used with -workers, -archive or -cache")
+
+    if args.dump or args.checkpoint:
         if not os.path.exists(args.output_path):
             os.makedirs(args.output_path)
 
@@ -857,10 +3405,19 @@ def main():
         filters.append("warc-type:response")
         filters.append("content-type:application/http")
 
-    args.filter = [FilterObject(i) for i in filters]
+    args.filter = FilterSet(FilterObject(i) for i in filters)
 
     args.string = re.compile(args.string)
-    parse(args)
+    if args.index:
+        for filename in warc_files(args.string, args.path):
+            print("indexing", filename)
+            build_index(args.path + filename)
+        return
+
+    if args.profile:
+        profile_parse(args)
+    else:
+        parse(args)
 
 
 if __name__ == "__main__":